@@ -0,0 +1,285 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import numpy_financial as npf
+import polars as pl
+
+from data_quality_engine import DataQualityEngine
+from formula_parser import parse_formula
+from formula_to_polars import FormulaToPolarsListener, _parse_formula
+
+
+def _time(func, repeat: int = 3) -> float:
+    """Best wall time of ``repeat`` runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def create_loan_book(rows: int, seed: int = 0) -> pl.DataFrame:
+    rng = np.random.default_rng(seed)
+    rate = rng.uniform(0.0, 0.12, rows)
+    rate[rng.random(rows) < 0.01] = 0.0
+    return pl.DataFrame({
+        "Rate": rate / 12,
+        "Periods": rng.integers(12, 361, rows),
+        "Payment": -rng.uniform(100, 5000, rows),
+        "Principal": rng.uniform(1_000, 500_000, rows),
+    })
+
+
+# numpy_financial per-row path that FV/PV/PMT used to compile to
+_ROW_WISE = {
+    "FV": lambda: pl.struct(rate=pl.col("Rate"), nper=pl.col("Periods"), pmt=pl.col("Payment"), pv=pl.col("Principal"))
+    .map_elements(lambda x: npf.fv(x['rate'], x['nper'], x['pmt'], x['pv']), return_dtype=pl.Float64),
+    "PV": lambda: pl.struct(rate=pl.col("Rate"), nper=pl.col("Periods"), pmt=pl.col("Payment"), fv=pl.lit(0))
+    .map_elements(lambda x: npf.pv(x['rate'], x['nper'], x['pmt'], x['fv']), return_dtype=pl.Float64),
+    "PMT": lambda: pl.struct(rate=pl.col("Rate"), nper=pl.col("Periods"), pv=pl.col("Principal"), fv=pl.lit(0))
+    .map_elements(lambda x: npf.pmt(float(x['rate']), float(x['nper']), float(x['pv']), float(x['fv'])),
+                  return_dtype=pl.Float64),
+}
+
+_FORMULAS = {
+    "FV": "=FV(Rate, Periods, Payment, Principal)",
+    "PV": "=PV(Rate, Periods, Payment)",
+    "PMT": "=PMT(Rate, Periods, Principal)",
+}
+
+
+def bench_financial(rows: int = 200_000):
+    """Native FV/PV/PMT expressions versus the per-row numpy_financial callbacks."""
+    df = create_loan_book(rows)
+    listener = FormulaToPolarsListener()
+    print(f"Financial functions, {rows:,} rows")
+    for name, formula in _FORMULAS.items():
+        native = listener.convert_to_expr(formula)
+        row_wise = _ROW_WISE[name]()
+        native_result = df.select(native.alias("x"))["x"].to_numpy()
+        row_wise_result = df.select(row_wise.alias("x"))["x"].to_numpy()
+        assert np.allclose(native_result, row_wise_result, rtol=1e-9, atol=1e-6, equal_nan=True), name
+
+        native_time = _time(lambda: df.select(native))
+        row_wise_time = _time(lambda: df.select(row_wise), repeat=1)
+        print(f"  {name:<4} native {native_time * 1000:9.1f} ms   map_elements {row_wise_time * 1000:9.1f} ms"
+              f"   speedup {row_wise_time / native_time:7.1f}x")
+
+
+def bench_solvers(rows: int = 5_000):
+    """Batched Newton RATE/IRR versus per-row numpy_financial.rate / numpy_financial.irr."""
+    df = create_loan_book(rows).with_columns(
+        CashFlows=pl.concat_list(-pl.col("Principal"), *[pl.col("Principal") * share for share in (0.3, 0.4, 0.5)]))
+    listener = FormulaToPolarsListener()
+    row_wise = {
+        "RATE": pl.struct(nper=pl.col("Periods"), pmt=pl.col("Payment"), pv=pl.col("Principal"))
+        .map_elements(lambda x: npf.rate(float(x['nper']), float(x['pmt']), float(x['pv']), 0.0),
+                      return_dtype=pl.Float64),
+        "IRR": pl.col("CashFlows").map_elements(lambda x: npf.irr(x), return_dtype=pl.Float64),
+    }
+    formulas = {"RATE": "=RATE(Periods, Payment, Principal)", "IRR": "=IRR(CashFlows)"}
+    print(f"Rate solvers, {rows:,} rows")
+    for name, formula in formulas.items():
+        batched = listener.convert_to_expr(formula)
+        batched_result = df.select(batched.alias("x"))["x"].fill_null(np.nan).to_numpy()
+        row_wise_result = df.select(row_wise[name].alias("x"))["x"].to_numpy()
+        assert np.allclose(batched_result, row_wise_result, rtol=1e-6, atol=1e-8, equal_nan=True), name
+
+        batched_time = _time(lambda: df.select(batched))
+        row_wise_time = _time(lambda: df.select(row_wise[name]), repeat=1)
+        print(f"  {name:<4} batched {batched_time * 1000:8.1f} ms   map_elements {row_wise_time * 1000:9.1f} ms"
+              f"   speedup {row_wise_time / batched_time:7.1f}x")
+
+
+def bench_decimal_format(rows: int = 200_000, decimals: int = 2):
+    """Native number:decimal:N format predicates versus the per-row map_elements check they replaced."""
+    rng = np.random.default_rng(0)
+    scale = 10.0 ** rng.integers(0, 4, rows)
+    amounts = np.round(rng.uniform(0, 10_000, rows) * scale) / scale
+    df = pl.DataFrame({"Amount": amounts}).with_columns(AmountText=pl.col("Amount").cast(pl.Utf8))
+    row_wise = pl.col("Amount").map_elements(lambda x: abs(x - round(x, decimals)) < 1e-10, return_dtype=pl.Boolean)
+    native = DataQualityEngine._format_predicate("Amount", f"number:decimal:{decimals}")
+    text = DataQualityEngine._format_predicate("AmountText", f"number:decimal:{decimals}:string")
+    expected = df.select(row_wise)["Amount"]
+    assert df.select(native)["Amount"].equals(expected)
+    assert df.select(text)["AmountText"].equals(expected)
+
+    row_wise_time = _time(lambda: df.select(row_wise), repeat=1)
+    print(f"Decimal format rule, {rows:,} rows")
+    for name, predicate in (("numeric", native), ("string", text)):
+        native_time = _time(lambda: df.select(predicate))
+        print(f"  {name:<8} native {native_time * 1000:8.1f} ms   map_elements {row_wise_time * 1000:9.1f} ms"
+              f"   speedup {row_wise_time / native_time:7.1f}x")
+
+
+def bench_dictionary_encoding(rows: int = 2_000_000, distinct: int = 300):
+    """Rules on low-cardinality string columns evaluated per distinct value versus over every row."""
+    rng = np.random.default_rng(0)
+    codes = np.array([f"{chr(65 + i % 26)}{chr(65 + i // 26 % 26)}X{i:03d}" for i in range(distinct)])
+    df = pl.DataFrame({
+        "department": codes[rng.integers(0, distinct, rows)],
+        "country": np.array(["US", "GB", "DE", "fr", "JP", "BR"])[rng.integers(0, 6, rows)],
+        "amount": rng.uniform(0, 1_000, rows),
+    })
+    rules = pl.DataFrame({
+        "rule_id": ["1", "2", "3", "4"],
+        "column": ["department", "department", "country", "amount"],
+        "rule_type": ["regex", "excel", "format", "excel"],
+        "rule_expression": [r"^[A-Z]{2}X\d{3}$", 'IF(LEFT(UPPER([department]), 2) <> "ZZ", TRUE, FALSE)',
+                            "string:^[A-Z]{2}$", "[amount] >= 0"],
+        "error_message": ["Bad department code", "Reserved department", "Bad country code", "Negative amount"],
+    })
+    with tempfile.TemporaryDirectory() as directory:
+        rules_file = os.path.join(directory, "rules.xlsx")
+        rules.write_excel(rules_file)
+        plain = DataQualityEngine(rules_file, dictionary_threshold=0)
+        encoded = DataQualityEngine(rules_file)
+    assert plain.validate(df)["failed_count"].equals(encoded.validate(df)["failed_count"])
+
+    plain_time = _time(lambda: plain.validate(df))
+    encoded_time = _time(lambda: encoded.validate(df))
+    print(f"Dictionary-encoded rules, {rows:,} rows")
+    print(f"  per row {plain_time * 1000:8.1f} ms   per distinct value {encoded_time * 1000:8.1f} ms"
+          f"   speedup {plain_time / encoded_time:5.1f}x")
+    for column, figures in encoded.metrics["dictionary_encoded"].items():
+        print(f"  {column:<10} {figures['distinct']:5d} distinct, rules {figures['rules']},"
+              f" {figures['evaluation_ratio']:,.0f}x fewer predicate evaluations")
+    if encoded.metrics["dictionary_encoded"]:
+        print(f"  encoding {encoded.metrics['dictionary_seconds'] * 1000:8.1f} ms,"
+              f" estimated saving {encoded.metrics['dictionary_seconds_saved'] * 1000:8.1f} ms"
+              f" (measured {(plain_time - encoded_time) * 1000:8.1f} ms)")
+
+
+def bench_projection(rows: int = 50_000, columns: int = 400, referenced: int = 30):
+    """validate_path reading only the columns the rules reference versus loading the whole file first."""
+    rng = np.random.default_rng(0)
+    df = pl.DataFrame({f"c{i:03d}": rng.uniform(-1, 1_000, rows) for i in range(columns)})
+    rules = pl.DataFrame({
+        "rule_id": [str(i) for i in range(referenced)],
+        "column": [f"c{i:03d}" for i in range(referenced)],
+        "rule_type": ["excel"] * referenced,
+        "rule_expression": [f"[c{i:03d}] >= 0" for i in range(referenced)],
+        "error_message": ["Negative value"] * referenced,
+    })
+    with tempfile.TemporaryDirectory() as directory:
+        rules_file = os.path.join(directory, "rules.xlsx")
+        path = os.path.join(directory, "data.parquet")
+        rules.write_excel(rules_file)
+        df.write_parquet(path)
+        engine = DataQualityEngine(rules_file)
+        loaded = engine.validate(pl.read_parquet(path))
+        assert engine.validate_path(path, directory, batch_size=rows)["failed_count"].equals(loaded["failed_count"])
+        assert len(engine.metrics["columns"]) == referenced + 1
+
+        loaded_time = _time(lambda: engine.validate(pl.read_parquet(path)))
+        projected_time = _time(lambda: engine.validate_path(path, directory, batch_size=rows))
+    print(f"Projection pushdown, {rows:,} rows x {columns} columns, {referenced} referenced")
+    print(f"  load then validate {loaded_time * 1000:8.1f} ms   validate_path {projected_time * 1000:8.1f} ms"
+          f"   speedup {loaded_time / projected_time:5.1f}x")
+
+
+_GIL_BOUND_FUNCTIONS = """
+import polars as pl
+
+
+def _luhn(digits):
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        value = int(digit) * (2 if position % 2 else 1)
+        total += value - 9 if value > 9 else value
+    return total % 10 == 0
+
+
+def valid_card(df, column):
+    return pl.Series([_luhn(value) for value in df[column]], dtype=pl.Boolean)
+"""
+
+
+def bench_parallel_python(rows: int = 100_000, rules: int = 4, workers: int = None):
+    """GIL-bound python rules run serially versus on a pool of worker processes."""
+    workers = workers or os.cpu_count()
+    rng = np.random.default_rng(0)
+    df = pl.DataFrame({f"card{i}": rng.integers(10 ** 15, 10 ** 16, rows).astype(str) for i in range(rules)})
+    rules_df = pl.DataFrame({
+        "rule_id": [str(i) for i in range(rules)],
+        "column": [f"card{i}" for i in range(rules)],
+        "rule_type": ["python"] * rules,
+        "rule_expression": ["valid_card"] * rules,
+        "error_message": ["Invalid card number"] * rules,
+    })
+    with tempfile.TemporaryDirectory() as directory:
+        rules_file = os.path.join(directory, "rules.xlsx")
+        functions_file = os.path.join(directory, "card_functions.py")
+        rules_df.write_excel(rules_file)
+        with open(functions_file, "w") as f:
+            f.write(_GIL_BOUND_FUNCTIONS)
+        serial = DataQualityEngine(rules_file)
+        with DataQualityEngine(rules_file, workers=workers) as parallel:
+            for engine in (serial, parallel):
+                engine.load_custom_functions(functions_file)
+            assert serial.validate(df)["failed_count"].equals(parallel.validate(df)["failed_count"])
+
+            serial_time = _time(lambda: serial.validate(df))
+            parallel_time = _time(lambda: parallel.validate(df))
+    print(f"Python rules, {rules} rules x {rows:,} rows, {workers} workers")
+    print(f"  serial {serial_time * 1000:8.1f} ms   process pool {parallel_time * 1000:8.1f} ms"
+          f"   speedup {serial_time / parallel_time:5.1f}x")
+    for pid, figures in parallel.metrics["workers"].items():
+        print(f"  worker {pid}: {figures['tasks']} tasks, {figures['seconds'] * 1000:8.1f} ms")
+
+
+def nested_formula(depth: int) -> str:
+    """IFs nested ``depth`` deep, each condition mixing every precedence level of the grammar."""
+    formula = "Price"
+    for level in range(depth):
+        formula = f"IF(Price * {level + 1} + Tax / 2 - Quantity ^ 2 > {level} && Tax < 100, {formula}, -{level})"
+    return "=" + formula
+
+
+def bench_parsing(count: int = 200):
+    """Parse throughput of SLL-first two-stage parsing and the hand-written parser versus full-LL prediction."""
+    formulas = {
+        "simple": [f"=Price * Quantity + Tax - {i}" for i in range(count)],
+        "nested (depth 10)": [nested_formula(10).replace("Price", f"Price{i}") for i in range(count)],
+    }
+    print(f"Formula parsing, {count} formulas per kind")
+    for kind, batch in formulas.items():
+        ll_time = _time(lambda: [_parse_formula(formula, sll=False) for formula in batch])
+        sll_time = _time(lambda: [_parse_formula(formula) for formula in batch])
+        pratt_time = _time(lambda: [parse_formula(formula) for formula in batch])
+        print(f"  {kind:<18} LL {count / ll_time:8.0f} formulas/s   SLL-then-LL {count / sll_time:8.0f} formulas/s"
+              f" ({ll_time / sll_time:4.2f}x)   pratt {count / pratt_time:8.0f} formulas/s ({ll_time / pratt_time:4.1f}x)")
+
+
+# Modules a plain `import data_quality_engine` must not load; they are imported when first needed
+_DEFERRED_MODULES = ("pandas", "numpy", "numpy_financial", "antlr4", "formula_to_polars")
+
+
+def check_import_time(module: str = "data_quality_engine", budget: float = 0.5, repeat: int = 3):
+    """Cold-start ``import module`` in fresh interpreters; fail if the best time exceeds ``budget`` seconds."""
+    script = (f"import sys, time; start = time.perf_counter(); import {module}; "
+              f"print(time.perf_counter() - start); print(','.join(m for m in {_DEFERRED_MODULES!r} if m in sys.modules))")
+    best = float("inf")
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        elapsed, loaded = output.splitlines()[-2:]
+        best = min(best, float(elapsed))
+    print(f"import {module}: {best * 1000:.0f} ms (budget {budget * 1000:.0f} ms)")
+    assert not loaded, f"import {module} eagerly loads {loaded}"
+    assert best <= budget, f"import {module} took {best:.3f}s, over the {budget:.3f}s budget"
+
+
+if __name__ == "__main__":
+    check_import_time()
+    bench_financial()
+    bench_solvers()
+    bench_decimal_format()
+    bench_dictionary_encoding()
+    bench_projection()
+    bench_parallel_python()
+    bench_parsing()
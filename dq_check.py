@@ -1,7 +1,10 @@
 import polars as pl
 
+from data_quality_engine import sampled_positions
 
-def run_dq_check(df: pl.DataFrame, rules: list[str], evaluate_dq_rule) -> list[dict]:
+
+def run_dq_check(df: pl.DataFrame, rules: list[str], evaluate_dq_rule, max_samples: int = None,
+                 sampling: str = "first", stratify_by: str = None, seed: int = 0) -> list[dict]:
     """
     Runs data quality checks on the given DataFrame using the provided rules.
 
@@ -9,22 +12,30 @@ def run_dq_check(df: pl.DataFrame, rules: list[str], evaluate_dq_rule) -> list[d
         df (pl.DataFrame): The DataFrame to check.
         rules (list[str]): List of DQ rules as strings.
         evaluate_dq_rule (callable): A function that takes df and a rule string and returns a boolean Series indicating where the rule passes.
+        max_samples (int): Report at most this many failed rows per rule (None reports all of them).
+        sampling (str): How the reported rows are chosen: "first", "reservoir" or "stratified".
+        stratify_by (str): Column whose values stratified sampling spreads the rows over.
+        seed (int): Random seed for reservoir sampling.
 
     Returns:
-        list[dict]: A list of dictionaries, each containing a failed rule and the corresponding row data.
+        list[dict]: A list of dictionaries, each containing a failed rule, the corresponding row data
+        and the exact number of rows failing the rule ("failed_count").
     """
     failures = []
     for rule in rules:
         try:
             # Evaluate the rule on the DataFrame
-            passed = evaluate_dq_rule(df, rule)
-            # Filter rows where the rule fails
-            failed_rows = df.filter(~passed)
+            failed = (~evaluate_dq_rule(df, rule)).fill_null(False).alias("failed")
+            # Select the (sampled) rows where the rule fails
+            flags = pl.DataFrame([failed] + ([df[stratify_by]] if stratify_by else []))
+            rows = flags.select(sampled_positions(pl.col("failed"), max_samples, sampling, stratify_by, seed))
+            failed_count = failed.sum()
             # For each failed row, add to the failures list
-            for row_dict in failed_rows.to_dicts():
+            for row_dict in df[rows["failed"]].to_dicts():
                 failures.append({
                     "rule": rule,
-                    "row": row_dict
+                    "row": row_dict,
+                    "failed_count": failed_count
                 })
         except Exception as e:
             # Handle errors in rule evaluation
@@ -63,4 +74,10 @@ failures = run_dq_check(df, rules, evaluate_dq_rule)
 
 # Print the report
 for failure in failures:
-    print(f"Rule '{failure['rule']}' failed for row: {failure['row']}")
\ No newline at end of file
+    print(f"Rule '{failure['rule']}' failed for row: {failure['row']}")
+
+# Report at most one row per rule; the counts stay exact
+sampled = run_dq_check(df, rules, evaluate_dq_rule, max_samples=1)
+assert [f["failed_count"] for f in sampled] == [3, 5]
+for failure in sampled:
+    print(f"Rule '{failure['rule']}' failed for {failure['failed_count']} rows, e.g. {failure['row']}")
\ No newline at end of file
@@ -0,0 +1,217 @@
+import re
+
+from antlr4.Token import CommonToken, Token
+from ExcelFormulaParser import ExcelFormulaParser
+
+# Hand-written tokenizer and precedence-climbing parser for the ExcelFormula.g4 language. It builds the
+# same ExcelFormulaParser.*Context trees as the generated ANTLR parser, so the listener, the visitor
+# and everything else walking parse trees work unchanged, but it skips the ANTLR runtime's adaptive
+# prediction. Any input the grammar rejects raises ValueError, as _parse_formula does.
+
+_P = ExcelFormulaParser
+
+# Literal tokens ('=', '&&', ...) get the implicit T__n types ANTLR assigned them
+_LITERAL_TYPES = {name.strip("'"): token_type for token_type, name in enumerate(_P.literalNames) if token_type}
+
+_WHITESPACE = re.compile(r'[ \t\r\n]+')
+_NUMBER = re.compile(r'-?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][+-]?[0-9]+)?')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+# ANTLR reads the grammar's [0-9]{4} as [0-9] followed by an (empty) action block, so the generated
+# lexer's DATE is a single digit, '-', digit, '-', digit. Reproduce that, not the intent.
+_DATE = re.compile(r'[0-9]-[0-9]-[0-9]')
+_IDENTIFIER = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*')
+
+# Operators of the left-recursive rules, loosest binding first; '^' binds like '*' and '/'
+_BINARY_LEVELS = (
+    (_P.LogicalExprContext, frozenset(_LITERAL_TYPES[op] for op in ('&&', '||'))),
+    (_P.CompareExprContext, frozenset(_LITERAL_TYPES[op] for op in ('=', '<>', '<', '>', '<=', '>='))),
+    (_P.AddExprContext, frozenset(_LITERAL_TYPES[op] for op in ('+', '-'))),
+    (_P.MultExprContext, frozenset(_LITERAL_TYPES[op] for op in ('*', '/', '^'))),
+)
+_LITERALS = frozenset((_P.NUMBER, _P.STRING, _P.BOOLEAN, _P.DATE))
+_MINUS = _LITERAL_TYPES['-']
+_LPAREN = _LITERAL_TYPES['(']
+_RPAREN = _LITERAL_TYPES[')']
+_COMMA = _LITERAL_TYPES[',']
+
+
+def _token(token_type: int, text: str, start: int, stop: int, index: int, line: int, column: int) -> CommonToken:
+    token = CommonToken(type=token_type, start=start, stop=stop)
+    token.text = text
+    token.tokenIndex = index
+    token.line = line
+    token.column = column
+    return token
+
+
+def tokenize(formula: str) -> list:
+    """Split ``formula`` into CommonTokens the way ExcelFormulaLexer does, ending with an EOF token.
+
+    Like the generated lexer this takes the longest match at each position, preferring the earlier
+    rule on a tie: '-5' is one NUMBER, 'TRUE' a BOOLEAN rather than an IDENTIFIER, '1-2-3' a DATE
+    rather than NUMBER '1' and NUMBER '-2', and '2025-01-15' three NUMBERs.
+    """
+    tokens = []
+    position, length = 0, len(formula)
+    line, line_start = 1, 0
+    while position < length:
+        char = formula[position]
+        match = _WHITESPACE.match(formula, position)
+        if match:
+            text = match.group()
+            if '\n' in text:
+                line += text.count('\n')
+                line_start = position + text.rindex('\n') + 1
+            position = match.end()
+            continue
+
+        if char.isdigit():
+            match = _DATE.match(formula, position)
+            token_type = _P.DATE
+            if not match:
+                match = _NUMBER.match(formula, position)
+                token_type = _P.NUMBER
+        elif char in '-.':
+            match = _NUMBER.match(formula, position)
+            token_type = _P.NUMBER
+        elif char == '"':
+            match = _STRING.match(formula, position)
+            token_type = _P.STRING
+        elif char.isalpha():
+            match = _IDENTIFIER.match(formula, position)
+            token_type = _P.BOOLEAN if match and match.group() in ('TRUE', 'FALSE') else _P.IDENTIFIER
+
+        if match:
+            text = match.group()
+        elif formula[position:position + 2] in _LITERAL_TYPES:
+            text = formula[position:position + 2]
+            token_type = _LITERAL_TYPES[text]
+        elif char in _LITERAL_TYPES:
+            text = char
+            token_type = _LITERAL_TYPES[text]
+        else:
+            raise ValueError(f"Syntax error at position {position - line_start}: "
+                             f"token recognition error at: {formula[position:position + 1]!r}")
+        tokens.append(_token(token_type, text, position, position + len(text) - 1, len(tokens),
+                             line, position - line_start))
+        position += len(text)
+    tokens.append(_token(Token.EOF, '<EOF>', length, length - 1, len(tokens), line, length - line_start))
+    return tokens
+
+
+class _Parser:
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.position = 0
+
+    @property
+    def current(self) -> CommonToken:
+        return self.tokens[self.position]
+
+    def error(self, expected: str):
+        token = self.current
+        raise ValueError(f"Syntax error at position {token.column}: expected {expected} at input {token.text!r}")
+
+    def match(self, ctx, token_type: int, expected: str):
+        if self.current.type != token_type:
+            self.error(expected)
+        ctx.addTokenNode(self.current)
+        self.position += 1
+
+    def open(self, context_class, parent):
+        ctx = context_class(None, parent, -1 if parent is None else 0)
+        if parent is not None:
+            parent.addChild(ctx)
+        ctx.start = self.current
+        return ctx
+
+    def close(self, ctx):
+        ctx.stop = self.tokens[self.position - 1]
+        return ctx
+
+    def formula(self):
+        ctx = self.open(_P.FormulaContext, None)
+        self.match(ctx, _LITERAL_TYPES['='], "'='")
+        self.expression(ctx)
+        if self.current.type != Token.EOF:
+            self.error("<EOF>")
+        ctx.addTokenNode(self.current)
+        return self.close(ctx)
+
+    def expression(self, parent):
+        ctx = self.open(_P.ExpressionContext, parent)
+        self.binary(ctx, 0)
+        return self.close(ctx)
+
+    def binary(self, parent, level: int):
+        """Parse the left-associative rule of ``_BINARY_LEVELS[level]``, nesting each operation as ANTLR does."""
+        context_class, operators = _BINARY_LEVELS[level]
+        ctx = self.open(context_class, parent)
+        self.operand(ctx, level)
+        self.close(ctx)
+        while self.current.type in operators:
+            # The tree so far becomes the left child of a new node of the same rule
+            parent.children.pop()
+            outer = context_class(None, parent, ctx.invokingState)
+            parent.addChild(outer)
+            outer.start = ctx.start
+            ctx.parentCtx = outer
+            outer.addChild(ctx)
+            outer.addTokenNode(self.current)
+            self.position += 1
+            self.operand(outer, level)
+            ctx = self.close(outer)
+        return ctx
+
+    def operand(self, parent, level: int):
+        if level + 1 < len(_BINARY_LEVELS):
+            self.binary(parent, level + 1)
+        else:
+            self.unary(parent)
+
+    def unary(self, parent):
+        ctx = self.open(_P.UnaryExprContext, parent)
+        if self.current.type == _MINUS:
+            ctx.addTokenNode(self.current)
+            self.position += 1
+        self.atom(ctx)
+        return self.close(ctx)
+
+    def atom(self, parent):
+        ctx = self.open(_P.AtomContext, parent)
+        token = self.current
+        if token.type == _P.IDENTIFIER:
+            if self.tokens[self.position + 1].type == _LPAREN:
+                self.function_call(ctx)
+            else:
+                column = self.open(_P.ColumnRefContext, ctx)
+                self.match(column, _P.IDENTIFIER, "IDENTIFIER")
+                self.close(column)
+        elif token.type in _LITERALS:
+            literal = self.open(_P.LiteralContext, ctx)
+            self.match(literal, token.type, "a literal")
+            self.close(literal)
+        elif token.type == _LPAREN:
+            self.match(ctx, _LPAREN, "'('")
+            self.expression(ctx)
+            self.match(ctx, _RPAREN, "')'")
+        else:
+            self.error("an operand")
+        return self.close(ctx)
+
+    def function_call(self, parent):
+        ctx = self.open(_P.FunctionCallContext, parent)
+        self.match(ctx, _P.IDENTIFIER, "IDENTIFIER")
+        self.match(ctx, _LPAREN, "'('")
+        if self.current.type != _RPAREN:
+            self.expression(ctx)
+            while self.current.type == _COMMA:
+                self.match(ctx, _COMMA, "','")
+                self.expression(ctx)
+        self.match(ctx, _RPAREN, "')'")
+        return self.close(ctx)
+
+
+def parse_formula(formula: str):
+    """Parse formula text into the ExcelFormulaParser.FormulaContext tree the ANTLR parser would build."""
+    return _Parser(tokenize(formula)).formula()
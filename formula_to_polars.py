@@ -1,24 +1,226 @@
 import antlr4
 from antlr4 import *
+from antlr4.error.ErrorListener import ErrorListener
+from antlr4.error.ErrorStrategy import DefaultErrorStrategy
+from antlr4.error.Errors import ParseCancellationException
 from ExcelFormulaLexer import ExcelFormulaLexer
 from ExcelFormulaParser import ExcelFormulaParser
 from ExcelFormulaListener import ExcelFormulaListener
+from ExcelFormulaVisitor import ExcelFormulaVisitor
+from formula_parser import parse_formula, tokenize
+from frames import Frame, _column_names
 import polars as pl
 import datetime
+import logging
 import warnings
 import math
-import numpy_financial as npf
+import operator
+import random
+import re
+import threading
+from collections import OrderedDict, namedtuple
 from functools import reduce
 import importlib
 
 
+class _RaiseSyntaxErrors(ErrorListener):
+    def syntaxError(self, recognizer, offendingSymbol, line, column, msg, e):
+        raise ValueError(f"Syntax error at position {column}: {msg}")
+
+
+def _parse_formula(formula: str, sll: bool = True):
+    """Parse formula text into an ExcelFormulaParser.FormulaContext tree; raises ValueError on a syntax error.
+
+    With ``sll`` the parse first runs in the cheaper SLL prediction mode, bailing out at the first
+    error; only then is it repeated in full LL mode, which either succeeds (input SLL cannot decide)
+    or reports the syntax error. The SLL pass has no parser error listener, so every error it meets
+    reaches the LL retry. The generated lexer and parser keep their ATN and DFA caches as class
+    attributes, so every instance shares the predictions already learned.
+    """
+    lexer = ExcelFormulaLexer(InputStream(formula))
+    lexer.removeErrorListeners()
+    lexer.addErrorListener(_RaiseSyntaxErrors())
+    stream = CommonTokenStream(lexer)
+    parser = ExcelFormulaParser(stream)
+    parser.removeErrorListeners()
+    if sll:
+        parser._interp.predictionMode = PredictionMode.SLL
+        parser._errHandler = BailErrorStrategy()
+        try:
+            return parser.formula()
+        except ParseCancellationException:
+            stream.seek(0)
+            parser.reset()
+            parser._interp.predictionMode = PredictionMode.LL
+            parser._errHandler = DefaultErrorStrategy()
+    parser.addErrorListener(_RaiseSyntaxErrors())
+    return parser.formula()
+
+
+logger = logging.getLogger(__name__)
+
+
+def _eval_globals(udf_modules: dict = None) -> dict:
+    """Namespace used to evaluate generated Polars source text, with the ``udf_modules`` it calls into."""
+    import numpy_financial as npf
+    eval_globals = {**(udf_modules or {}), 'pl': pl, 'math': math, 'datetime': datetime, 'npf': npf, 'reduce': reduce,
+                    '_rate_batch': _rate_batch, '_irr_batch': _irr_batch,
+                    '_npv_expr': _npv_expr, '_xnpv_expr': _xnpv_expr}
+    try:
+        # Attempt to import custom_functions, but don't fail if it doesn't exist
+        eval_globals['custom_functions'] = importlib.import_module('custom_functions')
+    except ImportError:
+        pass  # If custom_functions.py doesn't exist, external functions will fail at registration
+    return eval_globals
+
+
+_STRING_LITERAL = re.compile(r'("(?:[^"\\]|\\.)*")')
+
+
+def normalize_formula(formula: str) -> str:
+    """Collapse insignificant whitespace (outside string literals) so equivalent formulas share a cache key."""
+    parts = _STRING_LITERAL.split(formula.strip())
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts))
+
+
+_BRACKET_REFERENCE = re.compile(r'\[([^\]]*)\]')
+_IDENTIFIER = re.compile(r'[a-zA-Z][a-zA-Z0-9_]*')
+_LPAREN = ExcelFormulaParser.literalNames.index("'('")
+_RPAREN = ExcelFormulaParser.literalNames.index("')'")
+
+
+def excel_rule_formula(expression: str) -> tuple:
+    """Translate an excel rule expression into formula text the grammar accepts.
+
+    ``[column]`` references become plain identifiers. Names that are not identifiers (``[first name]``)
+    become placeholders, returned as ``{placeholder: column}``. The infix ``value IN (a, b)``, which
+    applies to the operand just before it, becomes the call ``IN(value, a, b)``. Returns
+    ``(formula, placeholders)``.
+    """
+    parts = _STRING_LITERAL.split(str(expression).strip())
+    names = {name for i, part in enumerate(parts) if not i % 2 for name in _BRACKET_REFERENCE.findall(part)}
+    placeholders = {}
+
+    def reference(match):
+        name = match.group(1)
+        if _IDENTIFIER.fullmatch(name):
+            return name
+        for placeholder, column in placeholders.items():
+            if column == name:
+                return placeholder
+        placeholder = f"column__{len(placeholders)}"
+        while placeholder in names:
+            placeholder += '_'
+        placeholders[placeholder] = name
+        return placeholder
+
+    formula = '=' + ''.join(part if i % 2 else _BRACKET_REFERENCE.sub(reference, part) for i, part in enumerate(parts))
+
+    operand_ends = {ExcelFormulaParser.IDENTIFIER, ExcelFormulaParser.NUMBER, ExcelFormulaParser.STRING,
+                    ExcelFormulaParser.BOOLEAN, ExcelFormulaParser.DATE, _RPAREN}
+    while True:
+        tokens = tokenize(formula)
+        for i, token in enumerate(tokens[1:-1], start=1):
+            if (token.type == ExcelFormulaParser.IDENTIFIER and token.text.upper() == 'IN'
+                    and tokens[i + 1].type == _LPAREN and tokens[i - 1].type in operand_ends):
+                break
+        else:
+            return formula, placeholders
+        start = _matching_token(tokens, i - 1, -1) if tokens[i - 1].type == _RPAREN else i - 1
+        if tokens[start].type == _LPAREN and tokens[start - 1].type == ExcelFormulaParser.IDENTIFIER:
+            start -= 1
+        end = _matching_token(tokens, i + 1, 1)
+        operand = formula[tokens[start].start:tokens[i - 1].stop + 1]
+        values = formula[tokens[i + 1].stop + 1:tokens[end].start]
+        formula = f"{formula[:tokens[start].start]}IN({operand}, {values}){formula[tokens[end].stop + 1:]}"
+
+
+def _matching_token(tokens: list, index: int, step: int) -> int:
+    """Index of the parenthesis matching ``tokens[index]``, searching in direction ``step``."""
+    depth = 0
+    while 0 <= index < len(tokens) - 1:
+        if tokens[index].type == _LPAREN:
+            depth += step
+        elif tokens[index].type == _RPAREN:
+            depth -= step
+        if depth == 0:
+            return index
+        index += step
+    raise ValueError("Syntax error: unbalanced parentheses around IN")
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class CompiledFormulaCache:
+    """Thread-safe, size-bounded LRU map from a formula key to its compiled form."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for ``key`` or None, counting the hit or miss."""
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+# Parsers producing ExcelFormulaParser trees, selected by FormulaToPolarsListener(parser=...)
+_PARSERS = {'antlr': _parse_formula, 'pratt': parse_formula}
+
+# Functions whose value depends on when the expression is built; expressions using them are not cached
+_VOLATILE_FUNCTIONS = {'TODAY', 'NOW'}
+
+
 class FormulaToPolarsListener(ExcelFormulaListener):
-    def __init__(self):
+    def __init__(self, cache_size: int = 1024, optimize: bool = True, parser: str = 'antlr'):
+        if parser not in _PARSERS:
+            raise ValueError(f"Unsupported parser: {parser}")
         self.stack = []
+        # 'antlr' uses the generated ExcelFormulaParser, 'pratt' the hand-written formula_parser
+        self.parser = parser
+        # Constant folding and boolean simplification in convert_to_expr; see explain()
+        self.optimize = optimize
+        self.foldable_functions = set(_FOLDABLE_FUNCTIONS)
+        # Bumped by register_custom_function; part of every cache key
+        self.registry_version = 0
+        self.cache = CompiledFormulaCache(cache_size)
+        # Top-level modules of functions registered by module_path, so generated text can name them
+        self.udf_modules = {}
         self.function_map = {
             # Mathematical
             'SUM': 'sum',
             'AVERAGE': 'mean',
+            'AVG': 'mean',
             'MIN': 'min',
             'MAX': 'max',
             'ABS': lambda args: f"abs({args[0]})",
@@ -40,6 +242,8 @@ class FormulaToPolarsListener(ExcelFormulaListener):
             'AND': lambda args: f"({' & '.join(args)})",
             'OR': lambda args: f"({' | '.join(args)})",
             'NOT': lambda args: f"~({args[0]})",
+            'IN': lambda args: f"({args[0]}).is_in([{', '.join(args[1:])}])",
+            'ISBLANK': lambda args: f"({args[0]}).is_null()",
             # Text
             'CONCAT': lambda args: f"pl.concat_str([{', '.join(self._mod_concat(args))}])",
             #'CONCAT': lambda args: f"pl.concat_str([{', '.join(args)}])",
@@ -70,33 +274,94 @@ class FormulaToPolarsListener(ExcelFormulaListener):
             'FV': self._handle_fv,
             'PV': self._handle_pv,
             'NPV': self._handle_npv,
+            'XNPV': self._handle_xnpv,
             'PMT': self._handle_pmt,
             'RATE': self._handle_rate,
             'IRR': self._handle_irr
         }
+        # Handlers used by convert_to_expr; they take and return pl.Expr / Python constants.
+        self.expr_function_map = FormulaToPolarsVisitor().function_map
+
+    def register_custom_function(self, func_name: str, handler=None, module_path: str = None, expr_handler=None,
+                                 vectorized: bool = False, return_dtype=pl.Float64, is_elementwise: bool = False,
+                                 returns_scalar: bool = False):
+        """Register a custom Excel-like function with a Polars handler or external Python function.
+
+        ``handler`` returns Polars source text; ``expr_handler`` returns a pl.Expr and is used by
+        convert_to_expr. Functions registered with only a text handler still work in expression mode.
 
-    def register_custom_function(self, func_name: str, handler=None, module_path: str = None):
-        """Register a custom Excel-like function with a Polars handler or external Python function."""
+        A ``module_path`` function is called once per row with Python scalars unless ``vectorized``
+        is set, in which case it is called once per batch with whole Series (constant arguments are
+        passed as plain values) through ``map_batches``. ``return_dtype`` declares the result type;
+        ``is_elementwise`` lets Polars split the input into chunks (streaming, parallel execution);
+        ``returns_scalar`` marks aggregations such as custom_functions.weighted_average.
+        """
+        name = func_name.upper()
         if module_path:
             try:
                 module_name, func = module_path.rsplit('.', 1)
                 module = importlib.import_module(module_name)
                 handler = getattr(module, func)
-                # Wrap external function to work with Polars Series
-                polars_handler = lambda \
-                    args: f"pl.struct({', '.join(f'arg{i}={arg}' for i, arg in enumerate(args))}).map_elements(lambda x: {module_path}({', '.join(f'x[\"arg{i}\"]' for i in range(len(args)))}), return_dtype=pl.Float64)"
-                self.function_map[func_name.upper()] = polars_handler
-            except (ImportError, AttributeError) as e:
+            except (ImportError, AttributeError, ValueError) as e:
                 raise ValueError(f"Failed to import function {module_path}: {str(e)}")
-        elif handler:
-            self.function_map[func_name.upper()] = handler
+            # Generated text calls the function by its dotted path
+            self.udf_modules[module_name.split('.')[0]] = importlib.import_module(module_name.split('.')[0])
+            if vectorized:
+                self.function_map[name] = self._batch_udf_text(module_path, return_dtype, is_elementwise, returns_scalar)
+                self.expr_function_map[name] = _batch_udf(handler, return_dtype, is_elementwise, returns_scalar)
+            else:
+                self.function_map[name] = self._row_udf_text(module_path, return_dtype)
+                self.expr_function_map[name] = _row_udf(handler, return_dtype)
+        elif handler or expr_handler:
+            if handler:
+                self.function_map[name] = handler
+                # Built-in expression handler must not shadow the user's override
+                self.expr_function_map.pop(name, None)
+            if expr_handler:
+                self.expr_function_map[name] = expr_handler
         else:
-            raise ValueError("Either handler or module_path must be provided")
+            raise ValueError("Either handler, expr_handler or module_path must be provided")
+        # A user handler may not be deterministic or row-wise, so it is never folded
+        self.foldable_functions.discard(name)
+        self.registry_version += 1
+        self.cache.clear()
+
+    def cache_info(self) -> CacheInfo:
+        """Hit/miss counters and size of the compiled-formula cache."""
+        return self.cache.info()
 
     def register_custom_function_old(self, func_name: str, handler):
         """Register a custom Excel-like function with a Polars or Python handler."""
         self.function_map[func_name.upper()] = handler
 
+    def _row_udf_text(self, module_path: str, return_dtype):
+        def handler(args):
+            fields = ', '.join(f'arg{i}={arg}' for i, arg in enumerate(args))
+            call_args = ', '.join(f"x['arg{i}']" for i in range(len(args)))
+            return (f"pl.struct({fields}).map_elements(lambda x: {module_path}({call_args}), "
+                    f"return_dtype={_dtype_text(return_dtype)})")
+        return handler
+
+    def _batch_udf_text(self, module_path: str, return_dtype, is_elementwise: bool, returns_scalar: bool):
+        def handler(args):
+            exprs, call_args = [], []
+            constant = [self._is_constant_text(arg) for arg in args]
+            if all(constant):
+                constant = [False] * len(args)
+            for arg, is_constant in zip(args, constant):
+                if is_constant:
+                    call_args.append(arg)
+                else:
+                    call_args.append(f's[{len(exprs)}]')
+                    exprs.append(arg)
+            return (f"pl.map_batches([{', '.join(exprs)}], lambda s: {module_path}({', '.join(call_args)}), "
+                    f"return_dtype={_dtype_text(return_dtype)}, is_elementwise={is_elementwise}, "
+                    f"returns_scalar={returns_scalar})")
+        return handler
+
+    def _is_constant_text(self, arg):
+        return self._lit_text(arg) != arg or arg in ('True', 'False') or arg.startswith("'")
+
     def _mod_concat(self, args):
         mod_args = []
         for x in args:
@@ -182,31 +447,57 @@ class FormulaToPolarsListener(ExcelFormulaListener):
 
 
 
+    def _lit_text(self, arg):
+        """Wrap numeric literal text in pl.lit so generated arithmetic stays a Polars expression."""
+        try:
+            float(arg)
+            return f"pl.lit({arg})"
+        except ValueError:
+            return arg
+
+    def _float_text(self, arg):
+        return f"({self._lit_text(arg)}).cast(pl.Float64)"
+
+    # FV/PV/PMT use the numpy_financial closed forms as native arithmetic; ``when`` is Excel's type
+    # argument (0 = payment at period end, 1 = at period start). Integer operands are cast to Float64
+    # first, as ``(1 + rate) ** nper`` overflows integer dtypes silently
     def _handle_fv(self, args):
-        rate, nper, pmt, pv = args + ['0'] * (4 - len(args))
-        return f"pl.struct(rate={rate}, nper={nper}, pmt={pmt}, pv={pv}).map_elements(lambda x: npf.fv(x['rate'], x['nper'], x['pmt'], x['pv']), return_dtype=pl.Float64)"
+        rate, nper, pmt, pv, when = [self._float_text(a) for a in args + ['0'] * (5 - len(args))]
+        temp = f"((1 + {rate}) ** {nper})"
+        return (f"pl.when({rate} == 0).then(-({pv} + {pmt} * {nper}))"
+                f".otherwise(-({pv} * {temp} + {pmt} * (1 + {rate} * {when}) / {rate} * ({temp} - 1)))"
+                f".cast(pl.Float64)")
 
     def _handle_pv(self, args):
-        rate, nper, pmt, fv = args + ['0'] * (4 - len(args))
-        return f"pl.struct(rate={rate}, nper={nper}, pmt={pmt}, fv={fv}).map_elements(lambda x: npf.pv(x['rate'], x['nper'], x['pmt'], x['fv']), return_dtype=pl.Float64)"
+        rate, nper, pmt, fv, when = [self._float_text(a) for a in args + ['0'] * (5 - len(args))]
+        temp = f"((1 + {rate}) ** {nper})"
+        fact = f"pl.when({rate} == 0).then({nper}).otherwise((1 + {rate} * {when}) * ({temp} - 1) / {rate})"
+        return f"(-({fv} + {pmt} * {fact}) / {temp}).cast(pl.Float64)"
 
     def _handle_npv(self, args):
         rate, *values = args
-        values_expr = f"pl.concat_list([{', '.join(values)}])"
-        return f"pl.struct(rate={rate}, values={values_expr}).map_elements(lambda x: npf.npv(x['rate'], x['values']), return_dtype=pl.Float64)"
+        return f"_npv_expr({rate}, pl.concat_list([{', '.join(values)}]))"
+
+    def _handle_xnpv(self, args):
+        rate, values, dates = args
+        return f"_xnpv_expr({rate}, {values}, {dates})"
 
     def _handle_pmt(self, args):
-        rate, nper, pv, fv = args + ['0'] * (4 - len(args))
-        return f"pl.struct(rate={rate}, nper={nper}, pv={pv}, fv={fv}).map_elements(lambda x: npf.pmt(float(x['rate']), float(x['nper']), float(x['pv']), float(x['fv'])), return_dtype=pl.Float64)"
+        rate, nper, pv, fv, when = [self._float_text(a) for a in args + ['0'] * (5 - len(args))]
+        temp = f"((1 + {rate}) ** {nper})"
+        fact = f"pl.when({rate} == 0).then({nper}).otherwise((1 + {rate} * {when}) * ({temp} - 1) / {rate})"
+        return f"(-({fv} + {pv} * {temp}) / {fact}).cast(pl.Float64)"
 
     def _handle_rate(self, args):
-        nper, pmt, pv, fv = args + ['0'] * (4 - len(args))
-        return f"pl.struct(nper={nper}, pmt={pmt}, pv={pv}, fv={fv}).map_elements(lambda x: npf.rate(float(x['nper']), float(x['pmt']), float(x['pv']), float(x['fv'])), return_dtype=pl.Float64)"
+        nper, pmt, pv, fv, when, guess = args + ['0', '0', str(SOLVER_GUESS)][len(args) - 3:]
+        return (f"pl.struct(nper={nper}, pmt={pmt}, pv={pv}, fv={fv}, when={when}, guess={guess})"
+                f".map_batches(_rate_batch, return_dtype=pl.Float64, is_elementwise=True)")
 
     def _handle_irr(self, args):
-        values = args
+        values, guess = _split_irr_guess(args, lambda arg: self._lit_text(arg) != arg)
         values_expr = f"pl.concat_list([{', '.join(values)}])"
-        return f"{values_expr}.map_elements(lambda x: npf.irr(x) if x is not None and len(x) > 1 and any(v != 0 for v in x) else float('nan'), return_dtype=pl.Float64)"
+        return (f"pl.struct(values={values_expr}, guess=pl.lit({guess if guess is not None else SOLVER_GUESS}))"
+                f".map_batches(_irr_batch, return_dtype=pl.Float64, is_elementwise=True)")
 
     def exitFormula(self, ctx):
         pass
@@ -279,54 +570,945 @@ class FormulaToPolarsListener(ExcelFormulaListener):
             warnings.warn(f"Function {func_name} not supported in Polars; returning raw expression.")
             self.stack.append(f"{func_name}({', '.join(args)})")
 
-    def convert_to_polars(self, formula: str) -> str:
-        input_stream = InputStream(formula)
-        lexer = ExcelFormulaLexer(input_stream)
-        stream = CommonTokenStream(lexer)
-        parser = ExcelFormulaParser(stream)
-        tree = parser.formula()
+    def _parse(self, formula: str):
+        return _PARSERS[self.parser](formula)
 
-        listener = FormulaToPolarsListener()
-        listener.function_map = self.function_map.copy()
+    @classmethod
+    def _walker_for(cls, function_map: dict):
+        """Bare listener sharing ``function_map``, skipping construction of the default tables."""
+        listener = cls.__new__(cls)
+        listener.stack = []
+        listener.function_map = function_map
+        return listener
 
+    def convert_to_polars(self, formula: str) -> str:
+        key = (normalize_formula(formula), 'string', self.registry_version)
+        polars_expr = self.cache.get(key)
+        if polars_expr is not None:
+            return polars_expr
+
+        tree = self._parse(formula)
+        listener = self._walker_for(self.function_map)
         walker = ParseTreeWalker()
         walker.walk(listener, tree)
 
-        return listener.stack[0]
+        polars_expr = listener.stack[0]
+        self.cache.put(key, polars_expr)
+        return polars_expr
 
-    def apply_formula(self, df: pl.DataFrame, formula: str, new_column: str) -> pl.DataFrame:
-        import custom_functions
-        polars_expr = self.convert_to_polars(formula)
-        print(f'excel: {formula}, polars: {polars_expr}')
-        eval_globals = {'pl': pl, 'math': math, 'datetime': datetime, 'npf': npf, 'reduce': reduce}
-        try:
-            # Attempt to import custom_functions, but don't fail if it doesn't exist
-            custom_functions = importlib.import_module('custom_functions')
-            eval_globals['custom_functions'] = custom_functions
-        except ImportError:
-            pass  # If custom_functions.py doesn't exist, external functions will fail at registration
+    def _expr_visitor(self, optimize: bool) -> 'FormulaToPolarsVisitor':
+        return FormulaToPolarsVisitor(self.expr_function_map, self.function_map, self.foldable_functions, optimize,
+                                      self.udf_modules)
+
+    def convert_to_expr(self, formula: str) -> pl.Expr:
+        """Compile a formula straight to a pl.Expr, without generating source text or calling eval."""
+        key = (normalize_formula(formula), 'expr' if self.optimize else 'expr-unoptimized', self.registry_version)
+        polars_expr = self.cache.get(key)
+        if polars_expr is not None:
+            return polars_expr
+
+        tree = self._parse(formula)
+        visitor = self._expr_visitor(self.optimize)
+        polars_expr = _lit(visitor.visit(tree))
+        if not visitor.volatile:
+            self.cache.put(key, polars_expr)
+        return polars_expr
+
+    def convert_rule_to_expr(self, expression: str) -> tuple:
+        """Compile an excel rule expression (see excel_rule_formula) to a pl.Expr.
+
+        Returns ``(expr, columns)``, ``columns`` being the column names it reads in order of first use.
+        The rule is parsed once; later calls for the same expression come from the cache.
+        """
+        key = (normalize_formula(str(expression)), 'rule' if self.optimize else 'rule-unoptimized',
+               self.registry_version)
+        compiled = self.cache.get(key)
+        if compiled is not None:
+            return compiled
+
+        formula, placeholders = excel_rule_formula(expression)
+        tree = self._parse(formula)
+        visitor = self._expr_visitor(self.optimize)
+        visitor.column_names = placeholders
+        polars_expr = _lit(visitor.visit(tree))
+        collector = _ColumnRefCollector()
+        ParseTreeWalker().walk(collector, tree)
+        compiled = (polars_expr, tuple(dict.fromkeys(placeholders.get(name, name) for name in collector.columns)))
+        if not visitor.volatile:
+            self.cache.put(key, compiled)
+        return compiled
+
+    def explain(self, formula: str) -> str:
+        """Describe how ``formula`` compiles: the optimizer rewrites applied and the resulting expression."""
+        tree = self._parse(formula)
+        unoptimized = _lit(self._expr_visitor(False).visit(tree))
+        visitor = self._expr_visitor(True)
+        optimized = _lit(visitor.visit(tree))
+        lines = [f"formula:     {formula}", f"unoptimized: {unoptimized}", "rewrites:"]
+        lines += [f"  {rewrite}" for rewrite in visitor.rewrites] or ["  (none)"]
+        lines.append(f"optimized:   {optimized}")
+        return '\n'.join(lines)
+
+    def apply_formula(self, df: Frame, formula: str, new_column: str, mode: str = 'expr') -> Frame:
+        """Add ``new_column`` computed from ``formula``.
+
+        ``mode='expr'`` builds the expression tree directly; ``mode='string'`` generates Polars
+        source text and evaluates it, which is slower but handy for debugging. A LazyFrame input
+        returns a LazyFrame, so errors raised while computing values surface on collect.
+        """
+        if mode == 'string':
+            polars_expr = self.convert_to_polars(formula)
+            logger.debug("excel: %s, polars: %s", formula, polars_expr)
+            try:
+                return df.with_columns(
+                    **{new_column: eval(polars_expr, _eval_globals(self.udf_modules))})
+            except Exception as e:
+                raise ValueError(f"Error applying formula {formula}: {str(e)}")
+        elif mode != 'expr':
+            raise ValueError(f"Unsupported compilation mode: {mode}")
 
         try:
-            return df.with_columns(
-                **{new_column: eval(polars_expr, eval_globals)})
+            polars_expr = self.convert_to_expr(formula)
+            return df.with_columns(**{new_column: polars_expr})
         except Exception as e:
             raise ValueError(f"Error applying formula {formula}: {str(e)}")
 
+    def compile_formula(self, formula: str, mode: str = 'expr') -> pl.Expr:
+        """Return a pl.Expr for ``formula`` using either compilation mode."""
+        if mode == 'expr':
+            return self.convert_to_expr(formula)
+        elif mode == 'string':
+            return _lit(eval(self.convert_to_polars(formula), _eval_globals(self.udf_modules)))
+        raise ValueError(f"Unsupported compilation mode: {mode}")
+
+    def referenced_columns(self, formula: str) -> tuple:
+        """Column names referenced by ``formula`` (its columnRef nodes), in order of first use."""
+        key = (normalize_formula(formula), 'columns', self.registry_version)
+        columns = self.cache.get(key)
+        if columns is not None:
+            return columns
+
+        collector = _ColumnRefCollector()
+        ParseTreeWalker().walk(collector, self._parse(formula))
+        columns = tuple(dict.fromkeys(collector.columns))
+        self.cache.put(key, columns)
+        return columns
+
+    def _parsed_formulas(self, formulas: dict, errors: dict) -> dict:
+        """The entries of ``formulas`` that parse; the others are recorded in ``errors``."""
+        parsed = {}
+        for new_column, formula in formulas.items():
+            try:
+                self.referenced_columns(formula)
+                parsed[new_column] = formula
+            except Exception as e:
+                errors[new_column] = f"Error applying formula {formula}: {str(e)}"
+        return parsed
+
+    def schedule_formulas(self, formulas: dict, errors: dict = None) -> list:
+        """Group ``{new_column: formula}`` into levels that can each run as one ``with_columns``.
+
+        A formula lands in the level after the last formula it references. References to columns
+        not produced by ``formulas`` (and a formula's reference to its own column, i.e. an in-place
+        update) are treated as inputs. Raises ValueError naming the cycle if there is one. A formula
+        that does not parse raises too, unless ``errors`` is given: it is then recorded there and
+        left out of the levels.
+        """
+        if errors is not None:
+            formulas = self._parsed_formulas(formulas, errors)
+        dependencies = {
+            new_column: {col for col in self.referenced_columns(formula) if col in formulas and col != new_column}
+            for new_column, formula in formulas.items()
+        }
+        levels = []
+        done = set()
+        pending = list(formulas)
+        while pending:
+            level = [col for col in pending if dependencies[col] <= done]
+            if not level:
+                raise ValueError(f"Circular formula dependency: {' -> '.join(_find_cycle(pending, dependencies))}")
+            levels.append(level)
+            done.update(level)
+            pending = [col for col in pending if col not in done]
+        return levels
+
+    def common_subexpressions(self, formulas: dict, reserved=(), errors: dict = None) -> tuple:
+        """Factor subexpressions shared by ``formulas`` out into temporary columns.
+
+        Returns ``(temporaries, rewritten)``: a ``{name: formula}`` for each function call or operation
+        that reads a column and occurs more than once, and ``formulas`` with each occurrence replaced by
+        a reference to its temporary. The largest shared subtree is factored first, so sharing nested
+        inside it becomes a chain of temporaries. Subtrees reading a column that a formula updates in
+        place are left alone. Temporary names avoid ``reserved`` and the keys of ``formulas``. A formula
+        that does not parse raises, unless ``errors`` is given: it is then recorded there and returned
+        unchanged.
+        """
+        taken = set(formulas) | set(reserved)
+        rewritten = dict(formulas)
+        if errors is not None:
+            formulas = self._parsed_formulas(formulas, errors)
+        in_place = {col for col, formula in formulas.items() if col in self.referenced_columns(formula)}
+        temporaries = {}
+        subtrees = {name: _shareable_subtrees(self._parse(formula), in_place) for name, formula in formulas.items()}
+        while True:
+            counts = {}
+            for name, nodes in subtrees.items():
+                for text, _, _ in nodes:
+                    # A temporary's own definition is not an occurrence of it
+                    if not (name in temporaries and text == nodes[-1][0]):
+                        counts[text] = counts.get(text, 0) + 1
+            shared = [text for text, count in counts.items() if count > 1]
+            if not shared:
+                return temporaries, rewritten
+            text = max(shared, key=len)
+
+            temporary = f"cse__{len(temporaries)}"
+            while temporary in taken:
+                temporary += '_'
+            taken.add(temporary)
+            for name, nodes in list(subtrees.items()):
+                spans = [(start, stop) for node_text, start, stop in nodes if node_text == text]
+                if not spans or (name in temporaries and nodes[-1][0] == text):
+                    continue
+                formula = temporaries.get(name, rewritten.get(name))
+                if temporary not in temporaries:
+                    start, stop = spans[0]
+                    temporaries[temporary] = '=' + formula[start:stop + 1]
+                    subtrees[temporary] = _shareable_subtrees(self._parse(temporaries[temporary]), in_place)
+                for start, stop in reversed(spans):
+                    formula = formula[:start] + temporary + formula[stop + 1:]
+                if name in temporaries:
+                    temporaries[name] = formula
+                else:
+                    rewritten[name] = formula
+                subtrees[name] = _shareable_subtrees(self._parse(formula), in_place)
+
+    def apply_formulas(self, df: Frame, formulas: dict, mode: str = 'expr', cse: bool = True) -> tuple:
+        """Add one column per ``{new_column: formula}`` entry, one ``with_columns`` pass per dependency level.
+
+        Formulas may reference columns produced by other formulas in the batch; see schedule_formulas.
+        Returns ``(df, errors)`` where ``errors`` maps each failed column to its error message; the
+        remaining columns are still added, except those depending on a failed one. For a LazyFrame
+        only compile and schema errors can be reported up front; the result stays lazy.
+
+        With ``cse`` subexpressions shared between formulas are computed once, as temporary columns
+        that are dropped again afterwards; see common_subexpressions.
+        """
+        if not cse:
+            return self._apply_formulas(df, formulas, mode)
+        columns = _column_names(df)
+        # Formulas that do not parse are left as they are, and reported by _apply_formulas
+        temporaries, rewritten = self.common_subexpressions(formulas, reserved=columns, errors={})
+        if not temporaries:
+            return self._apply_formulas(df, formulas, mode)
+
+        df, errors = self._apply_formulas(df, {**temporaries, **rewritten}, mode)
+        failed = {col: formula for col, formula in formulas.items() if col in errors}
+        if failed:
+            # Report failures against the formulas as written, not their rewritten form
+            df, errors = self._apply_formulas(df, failed, mode)
+        else:
+            errors = {}
+        # Drop the temporaries and keep the column order of a run without them
+        for level in self.schedule_formulas(formulas, {}):
+            columns += [col for col in level if col not in columns and col not in errors]
+        return df.select(columns), errors
+
+    def _apply_formulas(self, df: Frame, formulas: dict, mode: str) -> tuple:
+        errors = {}
+        levels = self.schedule_formulas(formulas, errors)
+        exprs = {}
+        for new_column, formula in formulas.items():
+            if new_column in errors:
+                continue
+            try:
+                exprs[new_column] = self.compile_formula(formula, mode).alias(new_column)
+            except Exception as e:
+                errors[new_column] = f"Error applying formula {formula}: {str(e)}"
+
+        for level in levels:
+            stage = {}
+            for new_column in level:
+                if new_column in errors:
+                    continue
+                failed = [col for col in self.referenced_columns(formulas[new_column])
+                          if col in errors and col != new_column]
+                if failed:
+                    errors[new_column] = f"Error applying formula {formulas[new_column]}: depends on failed columns {failed}"
+                else:
+                    stage[new_column] = exprs[new_column]
+            df = self._apply_stage(df, stage, formulas, errors)
+        return df, errors
+
+    @staticmethod
+    def _apply_stage(df: Frame, exprs: dict, formulas: dict, errors: dict) -> Frame:
+        lazy = isinstance(df, pl.LazyFrame)
+        try:
+            staged = df.with_columns(list(exprs.values()))
+            if lazy:
+                staged.collect_schema()
+            return staged
+        except Exception:
+            pass
+
+        # Some expression fails: evaluate them one by one to find which
+        columns = []
+        for new_column, polars_expr in exprs.items():
+            try:
+                if lazy:
+                    df.with_columns(polars_expr).collect_schema()
+                    columns.append(polars_expr)
+                else:
+                    columns.append(df.with_columns(polars_expr).get_column(new_column))
+            except Exception as e:
+                errors[new_column] = f"Error applying formula {formulas[new_column]}: {str(e)}"
+        return df.with_columns(columns)
+
+
+class _ColumnRefCollector(ExcelFormulaListener):
+    def __init__(self):
+        self.columns = []
+
+    def exitColumnRef(self, ctx):
+        self.columns.append(ctx.IDENTIFIER().getText())
+
+
+_SHAREABLE_OPERATIONS = (ExcelFormulaParser.LogicalExprContext, ExcelFormulaParser.CompareExprContext,
+                         ExcelFormulaParser.AddExprContext, ExcelFormulaParser.MultExprContext)
+
+
+def _shareable_subtrees(tree, exclude: set) -> list:
+    """``(text, start, stop)`` of each function call or operation in ``tree`` that reads a column.
+
+    ``text`` is the whitespace-free source, ``start``/``stop`` the inclusive character span; children
+    come before their parents. Subtrees reading a column in ``exclude`` are skipped.
+    """
+    found = []
+
+    def visit(node) -> set:
+        if isinstance(node, ExcelFormulaParser.ColumnRefContext):
+            return {node.getText()}
+        if not isinstance(node, ParserRuleContext):
+            return set()
+        columns = set()
+        for child in node.getChildren():
+            columns |= visit(child)
+        shareable = (isinstance(node, ExcelFormulaParser.FunctionCallContext)
+                     or isinstance(node, _SHAREABLE_OPERATIONS) and node.getChildCount() == 3
+                     or isinstance(node, ExcelFormulaParser.UnaryExprContext) and node.getChildCount() == 2)
+        if shareable and columns and not columns & exclude:
+            found.append((node.getText(), node.start.start, node.stop.stop))
+        return columns
+
+    visit(tree)
+    return found
+
+
+def _find_cycle(nodes: list, dependencies: dict) -> list:
+    """Return one dependency cycle among ``nodes`` as a closed path, e.g. ``['A', 'B', 'A']``."""
+    visiting, visited = [], set()
+
+    def visit(node):
+        if node in visiting:
+            return visiting[visiting.index(node):] + [node]
+        if node in visited:
+            return None
+        visiting.append(node)
+        for dep in sorted(dependencies[node]):
+            cycle = visit(dep)
+            if cycle:
+                return cycle
+        visiting.pop()
+        visited.add(node)
+        return None
+
+    for node in nodes:
+        cycle = visit(node)
+        if cycle:
+            return cycle
+    return nodes
+
+
+def _lit(value):
+    """Wrap a Python constant produced by the visitor as a Polars literal; expressions pass through."""
+    return value if isinstance(value, pl.Expr) else pl.lit(value)
+
+
+_DTYPE_NAME = re.compile(r"""('[^']*'|"[^"]*")|\b([A-Z]\w*)""")
+
+
+def _dtype_text(dtype) -> str:
+    """Source text for a Polars dtype, e.g. ``pl.List(pl.Float64)``; strings and None are kept as they are."""
+    def qualify(match):
+        quoted, name = match.groups()
+        return quoted or (name if name in ('None', 'True', 'False') else f'pl.{name}')
+    return _DTYPE_NAME.sub(qualify, repr(dtype))
+
+
+def _row_udf(function, return_dtype):
+    """Expression handler calling ``function`` once per row with Python scalars."""
+    def handler(args):
+        fields = pl.struct(**{f'arg{i}': _lit(arg) for i, arg in enumerate(args)})
+        return fields.map_elements(lambda x: function(*x.values()), return_dtype=return_dtype)
+    return handler
+
+
+def _batch_udf(function, return_dtype, is_elementwise: bool, returns_scalar: bool):
+    """Expression handler calling ``function`` once per batch with whole Series.
+
+    Constant arguments are passed through as Python values; if every argument is constant the
+    function receives length-1 Series instead.
+    """
+    def handler(args):
+        positions = [i for i, arg in enumerate(args) if isinstance(arg, pl.Expr)] or list(range(len(args)))
+
+        def call(series):
+            values = list(args)
+            for i, s in zip(positions, series):
+                values[i] = s
+            return function(*values)
+
+        return pl.map_batches([_lit(args[i]) for i in positions], call, return_dtype=return_dtype,
+                              is_elementwise=is_elementwise, returns_scalar=returns_scalar)
+    return handler
+
+
+def _annuity_factor(rate: pl.Expr, nper: pl.Expr, when: pl.Expr, temp: pl.Expr) -> pl.Expr:
+    """Sum of per-period growth factors, ``(1 + rate*when) * ((1 + rate)**nper - 1) / rate`` (``nper`` at rate 0)."""
+    return pl.when(rate == 0).then(nper).otherwise((1 + rate * when) * (temp - 1) / rate)
+
+
+def _discount_factors(rate, periods: pl.Expr) -> pl.Expr:
+    """List of ``(1 + rate) ** -t`` for each t in the list expression ``periods``.
+
+    Computed as ``exp(-t * log(1 + rate))``: list-times-scalar is a native kernel, list power is not.
+    """
+    return (periods * -(1 + _lit(rate)).log()).list.eval(pl.element().exp())
+
+
+def _npv_expr(rate, values) -> pl.Expr:
+    """numpy_financial.npv over a list expression: the first cash flow is at t = 0."""
+    values = _lit(values).cast(pl.List(pl.Float64))
+    return (values * _discount_factors(rate, pl.int_ranges(0, values.list.len()))).list.sum()
+
+
+def _xnpv_expr(rate, values, dates) -> pl.Expr:
+    """Excel XNPV: cash flows discounted by (date - first date) / 365 years."""
+    values = _lit(values).cast(pl.List(pl.Float64))
+    years = _lit(dates).list.eval((pl.element() - pl.element().first()).dt.total_days() / 365)
+    return (values * _discount_factors(rate, years)).list.sum()
+
+
+# RATE and IRR solve for the rate with Newton's method over whole columns at once. The start guess
+# is Excel's default; the iteration limit and tolerance are numpy_financial's. Rows that do not
+# converge are null (Excel's #NUM!). numpy is imported inside the solvers, on first use, so that
+# importing this module stays cheap.
+SOLVER_GUESS = 0.1
+SOLVER_MAX_ITERATIONS = 100
+SOLVER_TOLERANCE = 1e-6
 
 
+def _newton(rate: 'np.ndarray', active: 'np.ndarray', step) -> 'np.ndarray':
+    """Iterate ``rate -= step(rows, rate[rows])`` on the not-yet-converged rows; NaN where no convergence."""
+    import numpy as np
+    rate = rate.astype(np.float64, copy=True)
+    converged = np.zeros(len(rate), dtype=bool)
+    with np.errstate(all='ignore'):
+        for _ in range(SOLVER_MAX_ITERATIONS):
+            rows = np.flatnonzero(active & ~converged)
+            if len(rows) == 0:
+                break
+            delta = step(rows, rate[rows])
+            rate[rows] -= delta
+            converged[rows] = np.abs(delta) < SOLVER_TOLERANCE
+    rate[~converged] = np.nan
+    return rate
+
+
+def _rate_batch(s: pl.Series) -> pl.Series:
+    """RATE for a struct Series of nper, pmt, pv, fv, when and guess fields."""
+    import numpy as np
+    n, pmt, pv, fv, w, guess = (s.struct.field(name).cast(pl.Float64).to_numpy()
+                                for name in ('nper', 'pmt', 'pv', 'fv', 'when', 'guess'))
+
+    def step(rows, r):
+        # g / g' from numpy_financial.rate
+        n_, pmt_, pv_, fv_, w_ = n[rows], pmt[rows], pv[rows], fv[rows], w[rows]
+        t1 = (r + 1) ** n_
+        t2 = (r + 1) ** (n_ - 1)
+        g = fv_ + t1 * pv_ + pmt_ * (t1 - 1) * (r * w_ + 1) / r
+        gp = (n_ * t2 * pv_ - pmt_ * (t1 - 1) * (r * w_ + 1) / (r ** 2)
+              + n_ * pmt_ * t2 * (r * w_ + 1) / r + pmt_ * (t1 - 1) * w_ / r)
+        return g / gp
+
+    rate = _newton(guess, np.ones(len(guess), dtype=bool), step)
+    return pl.Series(s.name, rate).fill_nan(None)
+
+
+def _padded_cash_flows(values: pl.Series) -> tuple:
+    """Cash-flow lists as a zero-padded (rows, max_len) matrix plus each row's length.
+
+    Trailing zero cash flows do not change NPV, so padding keeps the per-row solution exact.
+    """
+    import numpy as np
+    lengths = values.list.len().fill_null(0).cast(pl.Int64).to_numpy()
+    # explode() emits one null for an empty or null list
+    flat = values.explode(empty_as_null=True).cast(pl.Float64).to_numpy()
+    slots = np.maximum(lengths, 1)
+    rows = np.repeat(np.arange(len(values)), slots)
+    cols = np.arange(len(flat)) - np.repeat(np.cumsum(slots) - slots, slots)
+    keep = cols < np.repeat(lengths, slots)
+    matrix = np.zeros((len(values), max(int(lengths.max(initial=0)), 1)))
+    matrix[rows[keep], cols[keep]] = flat[keep]
+    return matrix, lengths
+
+
+def _irr_batch(s: pl.Series) -> pl.Series:
+    """IRR for a struct Series of a cash-flow list field ``values`` and a ``guess`` field."""
+    import numpy as np
+    flows, lengths = _padded_cash_flows(s.struct.field('values'))
+    guess = s.struct.field('guess').cast(pl.Float64).to_numpy()
+    periods = np.arange(flows.shape[1])
+
+    def step(rows, r):
+        f = flows[rows]
+        discount = (1 + r)[:, None] ** -periods
+        npv = (f * discount).sum(axis=1)
+        d_npv = (-periods * f * discount).sum(axis=1) / (1 + r)
+        return npv / d_npv
+
+    # At least two cash flows, not all zero
+    active = (lengths > 1) & np.any(flows != 0, axis=1)
+    rate = _newton(np.broadcast_to(guess, (len(flows),)), active, step)
+    return pl.Series(s.name, rate).fill_nan(None)
+
+
+def _split_irr_guess(args: list, is_constant) -> tuple:
+    """Split IRR(values, guess) into cash flows and guess.
+
+    A trailing constant is Excel's guess only when the cash flows are a single column/expression;
+    otherwise all arguments are cash flows, e.g. IRR(-1000, 300, 400).
+    """
+    if len(args) == 2 and not is_constant(args[0]) and is_constant(args[1]):
+        return args[:1], args[1]
+    return args, None
+
+
+# Built-in, deterministic, row-wise functions: with constant arguments they are evaluated at
+# compile time. Names overridden by register_custom_function are removed per listener.
+_FOLDABLE_FUNCTIONS = frozenset({
+    'ABS', 'ROUND', 'CEILING', 'FLOOR', 'MOD', 'POWER', 'SQRT', 'IF', 'IFERROR', 'AND', 'OR', 'NOT',
+    'CONCAT', 'LEFT', 'RIGHT', 'MID', 'LEN', 'TRIM', 'UPPER', 'LOWER', 'SUBSTITUTE',
+    'YEAR', 'MONTH', 'DAY', 'DATE', 'DATEDIF', 'FV', 'PV', 'PMT',
+})
+
+
+def _is_constant(value) -> bool:
+    return isinstance(value, (bool, int, float, str, datetime.date))
+
+
+def _foldable_operands(op: str, left, right) -> bool:
+    """Whether Python evaluates ``left op right`` the way Polars would for these literals."""
+    if isinstance(left, bool) or isinstance(right, bool):
+        return isinstance(left, bool) and isinstance(right, bool) and op in ('&&', '||', '=', '<>')
+    if isinstance(left, (int, float)) and isinstance(right, (int, float)):
+        return op not in ('&&', '||')
+    if isinstance(left, str) and isinstance(right, str):
+        return op in ('=', '<>', '<', '>', '<=', '>=', '+')
+    if isinstance(left, datetime.date) and isinstance(right, datetime.date):
+        return op in ('=', '<>', '<', '>', '<=', '>=') and type(left) is type(right)
+    return False
+
+
+def _single_call(ctx):
+    """The functionCall an expression consists of (through single-child rules and parentheses), or None."""
+    while not isinstance(ctx, ExcelFormulaParser.FunctionCallContext):
+        if isinstance(ctx, ExcelFormulaParser.AtomContext) and ctx.getChildCount() == 3:
+            ctx = ctx.expression()
+        elif isinstance(ctx, ParserRuleContext) and ctx.getChildCount() == 1:
+            ctx = ctx.getChild(0)
+        else:
+            return None
+    return ctx
+
+
+# Functions returning a boolean whatever their arguments
+_BOOLEAN_FUNCTIONS = frozenset({'AND', 'OR', 'NOT', 'IN', 'ISBLANK'})
+
+
+def _is_predicate(ctx) -> bool:
+    """Whether an expression is a comparison, a logical operation or a boolean function call."""
+    while True:
+        if isinstance(ctx, (ExcelFormulaParser.LogicalExprContext, ExcelFormulaParser.CompareExprContext)) \
+                and ctx.getChildCount() == 3:
+            return True
+        if isinstance(ctx, ExcelFormulaParser.FunctionCallContext):
+            return ctx.IDENTIFIER().getText().upper() in _BOOLEAN_FUNCTIONS
+        if isinstance(ctx, ExcelFormulaParser.AtomContext) and ctx.getChildCount() == 3:
+            ctx = ctx.expression()
+        elif isinstance(ctx, ParserRuleContext) and ctx.getChildCount() == 1:
+            ctx = ctx.getChild(0)
+        else:
+            return False
+
+
+def _number(text: str):
+    return int(text) if text.lstrip('-').isdigit() else float(text)
+
+
+_BINARY_OPS = {
+    '&&': operator.and_,
+    '||': operator.or_,
+    '=': operator.eq,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '^': operator.pow,
+}
+
+
+class FormulaToPolarsVisitor(ExcelFormulaVisitor):
+    """Builds pl.Expr trees from the parse tree.
+
+    Mirrors FormulaToPolarsListener node by node, but returns expression objects instead of source
+    text. Literals are kept as Python constants (so handlers such as ROUND or LEFT receive plain ints)
+    and are wrapped with pl.lit only where an expression is required.
+    """
+
+    def __init__(self, function_map: dict = None, string_function_map: dict = None, foldable: set = None,
+                 optimize: bool = True, udf_modules: dict = None):
+        if function_map is None:
+            function_map = {
+                # Mathematical
+                'SUM': self._aggregate('sum'),
+                'AVERAGE': self._aggregate('mean'),
+                'AVG': self._aggregate('mean'),
+                'MIN': self._aggregate('min'),
+                'MAX': self._aggregate('max'),
+                'ABS': lambda args: _lit(args[0]).abs(),
+                'ROUND': lambda args: _lit(args[0]).round(args[1] if len(args) > 1 else 0),
+                'CEILING': lambda args: _lit(args[0]).ceil(),
+                'FLOOR': lambda args: _lit(args[0]).floor(),
+                'MOD': lambda args: _lit(args[0]) % _lit(args[1]),
+                'POWER': lambda args: _lit(args[0]) ** _lit(args[1]),
+                'SQRT': lambda args: _lit(args[0]).sqrt(),
+                'SUMPRODUCT': self._handle_sumproduct,
+                # Statistical
+                'MEDIAN': self._aggregate('median'),
+                'STDEV': self._aggregate('std'),
+                'VAR': self._aggregate('var'),
+                # Logical
+                'IF': self._handle_if,
+                'IFERROR': self._handle_iferror,
+                'AND': lambda args: reduce(operator.and_, [_lit(a) for a in args]),
+                'OR': lambda args: reduce(operator.or_, [_lit(a) for a in args]),
+                'NOT': lambda args: ~_lit(args[0]),
+                'IN': self._handle_in,
+                'ISBLANK': lambda args: _lit(args[0]).is_null(),
+                # Text
+                'CONCAT': lambda args: pl.concat_str([_lit(a) for a in args]),
+                'LEFT': lambda args: _lit(args[0]).str.slice(0, args[1]),
+                'RIGHT': lambda args: _lit(args[0]).str.slice(-args[1]),
+                'MID': lambda args: _lit(args[0]).str.slice(args[1], args[2]),
+                'LEN': lambda args: _lit(args[0]).str.len_chars(),
+                'TRIM': lambda args: _lit(args[0]).str.strip_chars(),
+                'UPPER': lambda args: _lit(args[0]).str.to_uppercase(),
+                'LOWER': lambda args: _lit(args[0]).str.to_lowercase(),
+                'SUBSTITUTE': lambda args: _lit(args[0]).str.replace(args[1], args[2]),
+                # Date/Time
+                'TODAY': lambda args: pl.lit(datetime.datetime.now().date()),
+                'NOW': lambda args: pl.lit(datetime.datetime.now()),
+                'YEAR': lambda args: _lit(args[0]).dt.year(),
+                'MONTH': lambda args: _lit(args[0]).dt.month(),
+                'DAY': lambda args: _lit(args[0]).dt.day(),
+                'DATE': lambda args: pl.lit(datetime.date(args[0], args[1], args[2])),
+                'DATEDIF': self._handle_datedif,
+                # Database
+                'COUNT': self._aggregate('count'),
+                'COUNTIF': self._handle_countif,
+                'SUMIF': self._handle_sumif,
+                # Financial
+                'FV': self._handle_fv,
+                'PV': self._handle_pv,
+                'NPV': self._handle_npv,
+                'XNPV': self._handle_xnpv,
+                'PMT': self._handle_pmt,
+                'RATE': self._handle_rate,
+                'IRR': self._handle_irr
+            }
+        self.function_map = function_map
+        # Text handlers (FormulaToPolarsListener.function_map) for functions with no expression handler
+        self.string_function_map = string_function_map or {}
+        # Modules the text handlers' source may call into (FormulaToPolarsListener.udf_modules)
+        self.udf_modules = udf_modules or {}
+        # Set when the tree calls a function such as TODAY() whose literal must not be cached
+        self.volatile = False
+        # Constant folding / boolean simplification; each applied rewrite is logged in ``rewrites``
+        self.optimize = optimize
+        self.foldable = _FOLDABLE_FUNCTIONS if foldable is None else foldable
+        self.rewrites = []
+        # Placeholder identifiers standing for column names the grammar cannot spell; see excel_rule_formula
+        self.column_names = {}
+
+    @staticmethod
+    def _aggregate(method: str):
+        return lambda args: getattr(reduce(operator.add, [_lit(a) for a in args]), method)()
+
+    @staticmethod
+    def _handle_in(args):
+        if len(args) < 2:
+            raise ValueError("IN requires a value and at least one candidate")
+        if all(_is_constant(a) for a in args[1:]):
+            return _lit(args[0]).is_in(args[1:])
+        return reduce(operator.or_, [_lit(args[0]) == _lit(a) for a in args[1:]])
+
+    def _handle_sumproduct(self, args):
+        if len(args) < 1:
+            raise ValueError("SUMPRODUCT requires at least one argument")
+        return reduce(operator.mul, [_lit(a) for a in args]).sum()
+
+    def _handle_if(self, args):
+        condition, true_val, false_val = args
+        return pl.when(_lit(condition)).then(_lit(true_val)).otherwise(_lit(false_val))
+
+    def _handle_iferror(self, args):
+        value, value_if_error = _lit(args[0]), _lit(args[1])
+        return pl.when(value.is_not_null()).then(value).otherwise(value_if_error)
+
+    def _handle_countif(self, args):
+        range_expr, criteria = args
+        return _lit(range_expr).filter(_lit(criteria)).count()
+
+    def _handle_sumif(self, args):
+        range_expr, criteria, sum_range = args if len(args) == 3 else [args[0], args[1], args[0]]
+        return _lit(sum_range).filter(_lit(criteria)).sum()
+
+    def _handle_datedif(self, args):
+        start_date, end_date, unit = args
+        unit = unit.lower()
+        # String literals are ISO dates
+        if isinstance(start_date, str):
+            start_date = pl.lit(start_date).str.to_date()
+        if isinstance(end_date, str):
+            end_date = pl.lit(end_date).str.to_date()
+
+        days = (_lit(end_date) - _lit(start_date)).dt.total_days()
+        if unit == 'd':
+            return days.cast(pl.Int32, strict=False)
+        elif unit == 'm':
+            return (days / 30.42).cast(pl.Int32, strict=False)
+        elif unit == 'y':
+            return (days / 365.25).cast(pl.Int32, strict=False)
+        else:
+            raise ValueError(f"Unsupported DATEDIF unit: {unit}")
+
+    def _handle_fv(self, args):
+        rate, nper, pmt, pv, when = [_lit(a).cast(pl.Float64) for a in args + [0] * (5 - len(args))]
+        temp = (1 + rate) ** nper
+        return pl.when(rate == 0).then(-(pv + pmt * nper)).otherwise(
+            -(pv * temp + pmt * (1 + rate * when) / rate * (temp - 1))).cast(pl.Float64)
+
+    def _handle_pv(self, args):
+        rate, nper, pmt, fv, when = [_lit(a).cast(pl.Float64) for a in args + [0] * (5 - len(args))]
+        temp = (1 + rate) ** nper
+        return (-(fv + pmt * _annuity_factor(rate, nper, when, temp)) / temp).cast(pl.Float64)
+
+    def _handle_npv(self, args):
+        rate, *values = args
+        return _npv_expr(rate, pl.concat_list([_lit(v) for v in values]))
+
+    def _handle_xnpv(self, args):
+        rate, values, dates = args
+        return _xnpv_expr(rate, values, dates)
+
+    def _handle_pmt(self, args):
+        rate, nper, pv, fv, when = [_lit(a).cast(pl.Float64) for a in args + [0] * (5 - len(args))]
+        temp = (1 + rate) ** nper
+        return (-(fv + pv * temp) / _annuity_factor(rate, nper, when, temp)).cast(pl.Float64)
+
+    def _handle_rate(self, args):
+        nper, pmt, pv, fv, when, guess = [_lit(a) for a in args + [0, 0, SOLVER_GUESS][len(args) - 3:]]
+        return pl.struct(nper=nper, pmt=pmt, pv=pv, fv=fv, when=when, guess=guess).map_batches(
+            _rate_batch, return_dtype=pl.Float64, is_elementwise=True)
+
+    def _handle_irr(self, args):
+        values, guess = _split_irr_guess(args, lambda arg: isinstance(arg, (int, float)))
+        values_expr = pl.concat_list([_lit(v) for v in values])
+        return pl.struct(values=values_expr, guess=pl.lit(guess if guess is not None else SOLVER_GUESS)).map_batches(
+            _irr_batch, return_dtype=pl.Float64, is_elementwise=True)
+
+    def _bridge(self, func_name, args):
+        """Evaluate a text handler's output with the already-built arguments bound as names."""
+        handler = self.string_function_map[func_name]
+        namespace = _eval_globals(self.udf_modules)
+        texts = []
+        for i, arg in enumerate(args):
+            if isinstance(arg, (bool, int, float, str)):
+                texts.append(repr(arg))
+            else:
+                namespace[f'_arg{i}'] = _lit(arg)
+                texts.append(f'_arg{i}')
+        if callable(handler):
+            source = handler(texts)
+        else:
+            source = f"({' + '.join(texts)}).{handler}()"
+        return eval(source, namespace)
+
+    def visitFormula(self, ctx):
+        return self.visit(ctx.expression())
+
+    def visitExpression(self, ctx):
+        return self.visit(ctx.logicalExpr())
+
+    def _rewrite(self, ctx, value, description: str = None):
+        self.rewrites.append(f"{ctx.getText()} -> {description or repr(value)}")
+        return value
+
+    def _simplify_logical(self, ctx, op, operands):
+        """Drop TRUE from AND / FALSE from OR, and reduce to the constant if the other one appears.
+
+        Polars uses Kleene logic (``null & FALSE`` is FALSE), so these rewrites are exact with nulls.
+        """
+        absorbing = op in ('||', 'OR')
+        if any(operand is absorbing for operand in operands):
+            return self._rewrite(ctx, absorbing)
+        remaining = [operand for operand in operands if not isinstance(operand, bool)]
+        if len(remaining) == len(operands):
+            return None
+        if not remaining:
+            return self._rewrite(ctx, not absorbing)
+        combine = operator.or_ if absorbing else operator.and_
+        return self._rewrite(ctx, reduce(combine, [_lit(r) for r in remaining]), 'literal operands dropped')
+
+    def _simplify_if(self, ctx, args):
+        if len(args) != 3:
+            return None
+        condition, true_val, false_val = args
+        if isinstance(condition, bool):
+            return self._rewrite(ctx, true_val if condition else false_val, 'constant condition')
+        # Only a boolean condition can stand for the IF; any other would raise unsimplified
+        if not isinstance(condition, pl.Expr) or not _is_predicate(ctx.expression(0)):
+            return None
+        # A null condition takes the FALSE branch, hence fill_null(False)
+        if true_val is True and false_val is False:
+            return self._rewrite(ctx, condition.fill_null(False), 'predicate')
+        if true_val is False and false_val is True:
+            return self._rewrite(ctx, ~condition.fill_null(False), 'negated predicate')
+        if type(true_val) is int and type(false_val) is int and {true_val, false_val} == {0, 1}:
+            predicate = condition.fill_null(False) if true_val == 1 else ~condition.fill_null(False)
+            return self._rewrite(ctx, predicate.cast(pl.Int32), 'predicate as 0/1')
+        return None
+
+    def _visit_binary(self, ctx):
+        if ctx.getChildCount() == 3:
+            left = self.visit(ctx.getChild(0))
+            right = self.visit(ctx.getChild(2))
+            op = ctx.getChild(1).getText()
+            if self.optimize:
+                if _foldable_operands(op, left, right):
+                    try:
+                        value = _BINARY_OPS[op](left, right)
+                    except (ArithmeticError, ValueError):
+                        value = None
+                    # e.g. a negative base to a fractional power is complex in Python
+                    if _is_constant(value) and not (type(value) is int and abs(value) >= 2 ** 63):
+                        return self._rewrite(ctx, value)
+                elif op in ('&&', '||'):
+                    simplified = self._simplify_logical(ctx, op, [left, right])
+                    if simplified is not None:
+                        return simplified
+            return _BINARY_OPS[op](_lit(left), _lit(right))
+        return self.visit(ctx.getChild(0))
+
+    visitLogicalExpr = _visit_binary
+    visitCompareExpr = _visit_binary
+    visitAddExpr = _visit_binary
+    visitMultExpr = _visit_binary
+
+    def visitUnaryExpr(self, ctx):
+        value = self.visit(ctx.atom())
+        if ctx.getChild(0).getText() == '-':
+            return -value
+        return value
+
+    def visitAtom(self, ctx):
+        if ctx.getChildCount() == 3:
+            return self.visit(ctx.expression())
+        return self.visit(ctx.getChild(0))
+
+    def visitColumnRef(self, ctx):
+        name = ctx.IDENTIFIER().getText()
+        return pl.col(self.column_names.get(name, name))
+
+    def visitLiteral(self, ctx):
+        if ctx.NUMBER():
+            return _number(ctx.NUMBER().getText())
+        elif ctx.STRING():
+            return ctx.STRING().getText()[1:-1]
+        elif ctx.BOOLEAN():
+            return ctx.BOOLEAN().getText() == 'TRUE'
+        elif ctx.DATE():
+            return datetime.date.fromisoformat(ctx.DATE().getText())
+
+    def visitFunctionCall(self, ctx):
+        func_name = ctx.IDENTIFIER().getText().upper()
+        optimize = self.optimize and func_name in self.foldable
+        if optimize and func_name == 'NOT' and len(ctx.expression()) == 1:
+            inner = _single_call(ctx.expression(0))
+            if inner is not None and inner.IDENTIFIER().getText().upper() == 'NOT' and len(inner.expression()) == 1:
+                return self._rewrite(ctx, self.visit(inner.expression(0)), 'double negation removed')
+        args = [self.visit(e) for e in ctx.expression()]
+
+        if func_name in _VOLATILE_FUNCTIONS:
+            self.volatile = True
+        if optimize:
+            simplified = None
+            if func_name in ('AND', 'OR') and not all(_is_constant(a) for a in args):
+                simplified = self._simplify_logical(ctx, func_name, args)
+            elif func_name == 'IF':
+                simplified = self._simplify_if(ctx, args)
+            elif args and all(_is_constant(a) for a in args):
+                simplified = self._fold_call(ctx, func_name, args)
+            if simplified is not None:
+                return simplified
+        if func_name in self.function_map:
+            return self.function_map[func_name](args)
+        elif func_name in self.string_function_map:
+            return self._bridge(func_name, args)
+        raise ValueError(f"Function {func_name} not supported in Polars")
+
+    def _fold_call(self, ctx, func_name, args):
+        """Evaluate a built-in function of constants once, at compile time."""
+        try:
+            value = pl.select(_lit(self.function_map[func_name](args)).alias('value')).item()
+        except Exception:
+            return None
+        return self._rewrite(ctx, value) if _is_constant(value) else None
+
+
+_default_listener = None
+
+
+def _get_default_listener() -> 'FormulaToPolarsListener':
+    """Shared listener (and compile cache) behind the module-level helpers."""
+    global _default_listener
+    if _default_listener is None:
+        _default_listener = FormulaToPolarsListener()
+    return _default_listener
+
 
 def convert_to_polars(formula: str) -> str:
-    input_stream = InputStream(formula)
-    lexer = ExcelFormulaLexer(input_stream)
-    stream = CommonTokenStream(lexer)
-    parser = ExcelFormulaParser(stream)
-    tree = parser.formula()
+    return _get_default_listener().convert_to_polars(formula)
 
-    listener = FormulaToPolarsListener()
-    walker = ParseTreeWalker()
-    walker.walk(listener, tree)
 
-    return listener.stack[0]
+def convert_to_expr(formula: str) -> pl.Expr:
+    return _get_default_listener().convert_to_expr(formula)
 
 
 def create_sample_dataframe():
@@ -343,7 +1525,9 @@ def create_sample_dataframe():
         "Rate": [0.05, 0.06, 0.04, 0.05],
         "Periods": [10, 5, 8, 12],
         "Payment": [-100, -150, -50, -200],
-        "CashFlows": [[-1000, 300, 400, 500], [-2000, 600, 700, 800], [-500, 200, 300, 400], [-3000, 900, 1000, 1100]]
+        "CashFlows": [[-1000, 300, 400, 500], [-2000, 600, 700, 800], [-500, 200, 300, 400], [-3000, 900, 1000, 1100]],
+        "CashFlowDates": [[datetime.date(2025, 1, 1), datetime.date(2025, 7, 1),
+                           datetime.date(2026, 1, 1), datetime.date(2026, 7, 1)]] * 4
     })
 
 '''
@@ -354,22 +1538,82 @@ def apply_formula(df: pl.DataFrame, formula: str, new_column: str, listener: For
     except Exception as e:
         raise ValueError(f"Error applying formula {formula}: {str(e)}")
 '''
-def apply_formula(df: pl.DataFrame, formula: str, new_column: str, listener: FormulaToPolarsListener = None) -> pl.DataFrame:
-    polars_expr = convert_to_polars(formula, listener)
-    eval_globals = {'pl': pl, 'math': math, 'datetime': datetime, 'npf': npf, 'reduce': reduce}
+def apply_formula(df: Frame, formula: str, new_column: str, listener: FormulaToPolarsListener = None) -> Frame:
+    listener = listener or _get_default_listener()
     try:
-        # Attempt to import custom_functions, but don't fail if it doesn't exist
-        custom_functions = importlib.import_module('custom_functions')
-        eval_globals['custom_functions'] = custom_functions
-    except ImportError:
-        pass  # If custom_functions.py doesn't exist, external functions will fail at registration
-    try:
-        return df.with_columns(**{new_column: eval(polars_expr, eval_globals)})
+        return df.with_columns(**{new_column: listener.convert_to_expr(formula)})
     except Exception as e:
         raise ValueError(f"Error applying formula {formula}: {str(e)}")
 
+def apply_formulas(df: Frame, formulas: dict, listener: FormulaToPolarsListener = None) -> tuple:
+    return (listener or _get_default_listener()).apply_formulas(df, formulas)
+
+
+def _values_match(actual_values, expected_values):
+    """Compare result values, floats with tolerance; None expects null. One expected value is broadcast."""
+    if len(expected_values) == 1:
+        expected_values = expected_values * len(actual_values)
+    if len(actual_values) != len(expected_values):
+        return False
+    for a, b in zip(actual_values, expected_values):
+        if b is None or a is None:
+            if a is not b:
+                return False
+        elif isinstance(b, float):
+            if abs(a - b) >= 1e-6:
+                return False
+        elif a != b:
+            return False
+    return True
+
+
 # Test suite
+def _tree_signature(node) -> tuple:
+    """Rule classes, token types, texts and spans of a parse tree, for comparing parsers."""
+    if isinstance(node, TerminalNode):
+        token = node.symbol
+        return token.type, token.text, token.start, token.stop, token.tokenIndex
+    children = node.children or []
+    assert all(child.parentCtx is node for child in children), f"broken parent link under {type(node).__name__}"
+    return (type(node).__name__, node.start.tokenIndex, node.stop.tokenIndex,
+            tuple(_tree_signature(child) for child in children))
+
+
+def _parse_outcome(parse, formula: str):
+    try:
+        return _tree_signature(parse(formula))
+    except ValueError:
+        return 'syntax error'
+
+
+# Fragments for fuzzing the parsers: every token kind plus near misses of the lexer rules
+_FUZZ_OPERANDS = ['Price', 'Tax', 'x_1', 'IF', 'TRUE', 'FALSE', 'TRUEX', 'true', '1', '-2', '3.5', '.5', '7.', '1e3',
+                  '2E-2', '1e', '"a b"', '"q\\"x"', '"open', '1-2-3', '1-2-34', '2025-01-15']
+_FUZZ_FRAGMENTS = _FUZZ_OPERANDS + ['(', ')', ',', '+', '-', '*', '/', '^', '=', '<>', '<', '>', '<=', '>=', '&&', '||',
+                                    '&', '|', '[', ' ', '\n']
+
+
+def _fuzz_formula(rng, depth: int = 0) -> str:
+    """A random formula: mostly grammatical, sometimes not, sometimes with lexer edge cases glued together."""
+    roll = rng.random()
+    if depth > 3 or roll < 0.3:
+        return rng.choice(_FUZZ_OPERANDS)
+    if roll < 0.5:
+        op = rng.choice(['+', '-', '*', '/', '^', '=', '<>', '<', '>', '<=', '>=', '&&', '||'])
+        return f"{_fuzz_formula(rng, depth + 1)}{rng.choice(['', ' '])}{op}{rng.choice(['', ' '])}{_fuzz_formula(rng, depth + 1)}"
+    if roll < 0.6:
+        return f"-{_fuzz_formula(rng, depth + 1)}"
+    if roll < 0.7:
+        return f"({_fuzz_formula(rng, depth + 1)})"
+    if roll < 0.9:
+        args = ', '.join(_fuzz_formula(rng, depth + 1) for _ in range(rng.randint(0, 3)))
+        return f"{rng.choice(['IF', 'SUM', 'f'])}({args})"
+    return ''.join(rng.choice(_FUZZ_FRAGMENTS) for _ in range(rng.randint(1, 6)))
+
+
 def run_tests():
+    import numpy_financial as npf
+
     df = create_sample_dataframe()
     listener = FormulaToPolarsListener()
 
@@ -382,7 +1626,23 @@ def run_tests():
     # Register an external function
     listener.register_custom_function(
         'WEIGHTED_AVERAGE',
-        module_path='custom_functions.weighted_average'
+        module_path='custom_functions.weighted_average',
+        vectorized=True,
+        returns_scalar=True
+    )
+
+    # Register an elementwise Series-level function
+    listener.register_custom_function(
+        'LOG1P',
+        module_path='numpy.log1p',
+        vectorized=True,
+        is_elementwise=True
+    )
+
+    # Register a per-row external function (fallback path)
+    listener.register_custom_function(
+        'HYPOT',
+        module_path='math.hypot'
     )
 
     test_cases = [
@@ -467,6 +1727,26 @@ def run_tests():
                 npf.npv(0.05, [-3000, 900, 1000, 1100])
             ]
         },
+        {
+            "formula": "=NPV(Rate, Price, Tax, Quantity)",
+            "new_column": "InlineNetPresentValue",
+            "expected_values": [
+                npf.npv(0.05, [100.0, 10.0, 5]),
+                npf.npv(0.06, [150.0, 15.0, 12]),
+                npf.npv(0.04, [-50.0, 5.0, 8]),
+                npf.npv(0.05, [200.0, 20.0, 15])
+            ]
+        },
+        {
+            "formula": "=XNPV(Rate, CashFlows, CashFlowDates)",
+            "new_column": "DatedNetPresentValue",
+            "expected_values": [
+                sum(v / 1.05 ** (d / 365) for v, d in zip([-1000, 300, 400, 500], [0, 181, 365, 546])),
+                sum(v / 1.06 ** (d / 365) for v, d in zip([-2000, 600, 700, 800], [0, 181, 365, 546])),
+                sum(v / 1.04 ** (d / 365) for v, d in zip([-500, 200, 300, 400], [0, 181, 365, 546])),
+                sum(v / 1.05 ** (d / 365) for v, d in zip([-3000, 900, 1000, 1100], [0, 181, 365, 546]))
+            ]
+        },
         {
             "formula": "=PMT(Rate, Periods, Price)",
             "new_column": "PaymentAmount",
@@ -483,10 +1763,20 @@ def run_tests():
             "expected_values": [
                 npf.rate(10, -100, 100, 0),
                 npf.rate(5, -150, 150, 0),
-                npf.rate(8, -50, -50, 0),
+                None,  # does not converge
                 npf.rate(12, -200, 200, 0)
             ]
         },
+        {
+            "formula": "=RATE(Periods * 30, Payment, Price * 500, 0, 1, 0.01)",
+            "new_column": "InterestRateDue",
+            "expected_values": [
+                npf.rate(300, -100, 50000, 0, 1, 0.01),
+                npf.rate(150, -150, 75000, 0, 1, 0.01),
+                npf.rate(240, -50, -25000, 0, 1, 0.01),
+                npf.rate(360, -200, 100000, 0, 1, 0.01)
+            ]
+        },
         {
             "formula": "=IRR(CashFlows)",
             "new_column": "InternalRate",
@@ -497,6 +1787,77 @@ def run_tests():
                 npf.irr([-3000, 900, 1000, 1100])
             ]
         },
+        {
+            "formula": "=IRR(CashFlows, 0.05)",
+            "new_column": "InternalRateGuess",
+            "expected_values": [
+                npf.irr([-1000, 300, 400, 500]),
+                npf.irr([-2000, 600, 700, 800]),
+                npf.irr([-500, 200, 300, 400]),
+                npf.irr([-3000, 900, 1000, 1100])
+            ]
+        },
+        {
+            "formula": "=IRR(Price * -10, Tax * 30, Tax * 40, Quantity)",
+            "new_column": "InternalRateInline",
+            "expected_values": [
+                npf.irr([-1000, 300, 400, 5]),
+                npf.irr([-1500, 450, 600, 12]),
+                None,  # all cash flows positive
+                npf.irr([-2000, 600, 800, 15])
+            ]
+        },
+        {
+            "formula": "=FV(0, Periods, Payment, Price, 1)",
+            "new_column": "FutureValueZeroRate",
+            "expected_values": [
+                npf.fv(0, 10, -100, 100, 1),
+                npf.fv(0, 5, -150, 150, 1),
+                npf.fv(0, 8, -50, -50, 1),
+                npf.fv(0, 12, -200, 200, 1)
+            ]
+        },
+        {
+            "formula": "=PV(Rate, Periods, Payment, 0, 1)",
+            "new_column": "PresentValueDue",
+            "expected_values": [
+                npf.pv(0.05, 10, -100, 0, 1),
+                npf.pv(0.06, 5, -150, 0, 1),
+                npf.pv(0.04, 8, -50, 0, 1),
+                npf.pv(0.05, 12, -200, 0, 1)
+            ]
+        },
+        {
+            "formula": "=PMT(Rate * 0, Periods, Price, Tax, 1)",
+            "new_column": "PaymentZeroRate",
+            "expected_values": [
+                npf.pmt(0, 10, 100, 10, 1),
+                npf.pmt(0, 5, 150, 15, 1),
+                npf.pmt(0, 8, -50, 5, 1),
+                npf.pmt(0, 12, 200, 20, 1)
+            ]
+        },
+        # Integer rate and periods: computed in Float64 rather than overflowing
+        {
+            "formula": "=PV(1, 80, -1)",
+            "new_column": "PresentValueIntegerRate",
+            "expected_values": [npf.pv(1.0, 80, -1)] * 4
+        },
+        {
+            "formula": "=FV(Quantity - Quantity + 1, Periods * 7, Payment)",
+            "new_column": "FutureValueIntegerRate",
+            "expected_values": [
+                npf.fv(1.0, 70, -100, 0),
+                npf.fv(1.0, 35, -150, 0),
+                npf.fv(1.0, 56, -50, 0),
+                npf.fv(1.0, 84, -200, 0)
+            ]
+        },
+        {
+            "formula": "=PMT(Quantity - Quantity + 1, 70, Payment)",
+            "new_column": "PaymentIntegerRate",
+            "expected_values": [npf.pmt(1.0, 70, -100), npf.pmt(1.0, 70, -150), npf.pmt(1.0, 70, -50), npf.pmt(1.0, 70, -200)]
+        },
         # Custom
         {
             "formula": "=CUSTOM_DISCOUNT(Price, 10)",
@@ -509,6 +1870,16 @@ def run_tests():
             "new_column": "TotalValue",
             "expected_values": [100.0 * 5 + 150.0 * 12 + (-50.0) * 8 + 200.0 * 15]
         },
+        {
+            "formula": "=LOG1P(Tax)",
+            "new_column": "LogTax",
+            "expected_values": [math.log1p(10.0), math.log1p(15.0), math.log1p(5.0), math.log1p(20.0)]
+        },
+        {
+            "formula": "=HYPOT(Tax, 0)",
+            "new_column": "HypotTax",
+            "expected_values": [10.0, 15.0, 5.0, 20.0]
+        },
         # External function
         {
             "formula": "=WEIGHTED_AVERAGE(Price, Quantity)",
@@ -517,23 +1888,184 @@ def run_tests():
         }
     ]
 
-    for test in test_cases:
-        formula = test["formula"]
-        new_column = test["new_column"]
-        expected_values = test["expected_values"]
-        try:
-            result_df = listener.apply_formula(df, formula, new_column)
-            actual_values = result_df[new_column].to_list()
-            # Handle float comparisons with tolerance
-            if isinstance(expected_values[0], float):
-                assert all(abs(a - b) < 1e-6 for a, b in zip(actual_values, expected_values)), \
-                    f"Failed: {formula}\nExpected: {expected_values}\nGot: {actual_values}"
-            else:
-                assert actual_values == expected_values, \
+    for mode in ('expr', 'string'):
+        for test in test_cases:
+            formula = test["formula"]
+            new_column = test["new_column"]
+            expected_values = test["expected_values"]
+            try:
+                result_df = listener.apply_formula(df, formula, new_column, mode=mode)
+                actual_values = result_df[new_column].to_list()
+                assert _values_match(actual_values, expected_values), \
                     f"Failed: {formula}\nExpected: {expected_values}\nGot: {actual_values}"
-            print(f"Passed: {formula} -> Added column '{new_column}' with values {actual_values}")
-        except Exception as e:
-            print(f"Error: {formula} -> {str(e)}")
+                print(f"Passed [{mode}]: {formula} -> Added column '{new_column}' with values {actual_values}")
+            except Exception as e:
+                print(f"Error [{mode}]: {formula} -> {str(e)}")
+
+    # Batch apply: every formula in one pass, failures reported per column
+    try:
+        formulas = {test["new_column"]: test["formula"] for test in test_cases}
+        formulas["Broken"] = "=UNKNOWN_FUNC(Price)"
+        formulas["BadType"] = "=UPPER(Price)"
+        formulas["BadSyntax"] = "=Price +"
+        formulas["AfterBadSyntax"] = "=BadSyntax * 2"
+        result_df, errors = listener.apply_formulas(df, formulas)
+        assert {"Broken", "BadType", "BadSyntax", "AfterBadSyntax"} <= set(errors), errors
+        assert "depends on failed columns ['BadSyntax']" in errors["AfterBadSyntax"], errors
+        for test in test_cases:
+            if test["new_column"] not in errors:
+                expected_values = test["expected_values"]
+                actual_values = result_df[test["new_column"]].to_list()
+                assert _values_match(actual_values, expected_values), \
+                    f"{test['formula']}: expected {expected_values}, got {actual_values}"
+        print(f"Passed: apply_formulas -> {len(formulas) - len(errors)} columns, errors for {sorted(errors)}")
+    except Exception as e:
+        print(f"Error: apply_formulas -> {str(e)}")
+
+    # Dependency-aware scheduling: chained formulas in any order, cycles rejected up front
+    try:
+        chained = {
+            "Net": "=Gross - Tax",
+            "Gross": "=Price * Quantity",
+            "Doubled": "=Gross * 2",
+            "Label": "=CONCAT(Name, \"-\", Category)",
+        }
+        assert listener.schedule_formulas(chained) == [["Gross", "Label"], ["Net", "Doubled"]]
+        result_df, errors = listener.apply_formulas(df, chained)
+        assert not errors, errors
+        assert result_df["Net"].to_list() == [490.0, 1785.0, -405.0, 2980.0]
+        try:
+            listener.schedule_formulas({"A": "=B + 1", "B": "=C + 1", "C": "=A + 1", "D": "=Price"})
+            raise AssertionError("cycle not detected")
+        except ValueError as e:
+            assert "A -> B -> C -> A" in str(e), str(e)
+        parse_errors = {}
+        assert listener.schedule_formulas({**chained, "Bad": "=Price +"}, parse_errors) == \
+            [["Gross", "Label"], ["Net", "Doubled"]]
+        assert set(parse_errors) == {"Bad"}, parse_errors
+        lazy_df, errors = listener.apply_formulas(df.lazy(), {**chained, "BadRef": "=Missing + 1"})
+        assert isinstance(lazy_df, pl.LazyFrame) and set(errors) == {"BadRef"}, errors
+        assert lazy_df.collect()["Net"].to_list() == [490.0, 1785.0, -405.0, 2980.0]
+        print("Passed: dependency-aware apply_formulas")
+    except Exception as e:
+        print(f"Error: dependency-aware apply_formulas -> {str(e)}")
+
+    # The hand-written parser builds the same trees as ANTLR and rejects the same inputs
+    try:
+        formulas = [test["formula"] for test in test_cases]
+        rng = random.Random(0)
+        formulas += [rng.choice(['=', '=', '=', '', '==']) + _fuzz_formula(rng) for _ in range(2000)]
+        mismatches = [formula for formula in formulas
+                      if _parse_outcome(_parse_formula, formula) != _parse_outcome(parse_formula, formula)]
+        assert not mismatches, f"parsers disagree on {mismatches[:5]}"
+        # SLL errors are retried in LL mode, so both modes reach the same outcome
+        mismatches = [formula for formula in formulas if _parse_outcome(_parse_formula, formula)
+                      != _parse_outcome(lambda text: _parse_formula(text, sll=False), formula)]
+        assert not mismatches, f"SLL and LL disagree on {mismatches[:5]}"
+        accepted = sum(_parse_outcome(parse_formula, formula) != 'syntax error' for formula in formulas)
+        pratt = FormulaToPolarsListener(parser='pratt')
+        assert df.with_columns(x=pratt.convert_to_expr("=IF(Price - 1 > 50, Price * -2, -Tax)"))["x"].to_list() == \
+            [-200.0, -300.0, -5.0, -400.0]
+        print(f"Passed: pratt parser matches ANTLR on {len(formulas)} formulas ({accepted} accepted)")
+    except Exception as e:
+        print(f"Error: pratt parser differential -> {str(e)}")
+
+    # Common subexpressions shared across a batch are computed once as temporary columns
+    try:
+        shared = {
+            "Ratio": "=ROUND(ABS(Price) / Tax, 2)",
+            "RatioPlusOne": "=ROUND(ABS(Price)/Tax, 2) + 1",
+            "Magnitude": "=ABS(Price) * Quantity",
+            "Upper": "=UPPER(TRIM(Name))",
+            "UpperLength": "=LEN(UPPER(TRIM(Name)))",
+            "Quantity": "=ABS(Price) * Quantity",
+        }
+        temporaries, rewritten = listener.common_subexpressions(shared)
+        assert sorted(temporaries.values()) == ["=ABS(Price)", "=ROUND(cse__2 / Tax, 2)", "=UPPER(TRIM(Name))"], \
+            temporaries
+        assert rewritten["Quantity"] == "=cse__2 * Quantity", "subtrees reading an in-place column must not be shared"
+        parse_errors = {}
+        assert listener.common_subexpressions({**shared, "Bad": "=ABS(Price) +"}, errors=parse_errors) == \
+            (temporaries, {**rewritten, "Bad": "=ABS(Price) +"})
+        assert set(parse_errors) == {"Bad"}, parse_errors
+        with_cse, errors = listener.apply_formulas(df, shared)
+        without_cse, _ = listener.apply_formulas(df, shared, cse=False)
+        assert not errors and with_cse.equals(without_cse), errors
+        print(f"Passed: common subexpression elimination -> {temporaries}")
+    except Exception as e:
+        print(f"Error: common subexpression elimination -> {str(e)}")
+
+    # Excel rule expressions: [column] references and infix IN
+    try:
+        assert excel_rule_formula('IF([Category] IN ("A", "B"), TRUE, FALSE)') == \
+            ('=IF(IN(Category, "A", "B"), TRUE, FALSE)', {})
+        assert excel_rule_formula('LEN(TRIM([unit price])) IN (1, 2) && "[x] IN (y)" <> [Name]') == \
+            ('=IN(LEN(TRIM(column__0)), 1, 2) && "[x] IN (y)" <> Name', {'column__0': 'unit price'})
+        rule_df = df.with_columns(pl.col("Price").alias("unit price"))
+        rule_expr, rule_columns = listener.convert_rule_to_expr(
+            'IF(AND([Category] IN ("A", "C"), [unit price] > 100), TRUE, FALSE)')
+        assert rule_columns == ("Category", "unit price"), rule_columns
+        assert rule_df.select(x=rule_expr)["x"].to_list() == [False, False, False, True]
+        assert listener.convert_rule_to_expr('IF([Category] IN ("A", "C"), TRUE, FALSE)') is \
+            listener.convert_rule_to_expr('IF([Category] IN ("A",  "C"), TRUE, FALSE)'), "rules are compiled once"
+        print("Passed: excel rule expressions")
+    except Exception as e:
+        print(f"Error: excel rule expressions -> {str(e)}")
+
+    # Constant folding and boolean simplification
+    try:
+        optimizer_cases = {
+            "=IF(Price * (1 + 0.2) > 100, TRUE, FALSE)": [True, True, False, True],
+            "=IF(Quantity > 10, 1, 0)": [0, 1, 0, 1],
+            "=IF(Quantity > 10, FALSE, TRUE)": [True, False, True, False],
+            "=NOT(NOT(Category = \"A\"))": [True, False, True, False],
+            "=AND(Price > 0, TRUE, 1 < 2)": [True, True, False, True],
+            "=OR(Price > 0, 2 * 3 = 6)": [True, True, True, True],
+            "=Date > DATE(2025, 1, 1)": [False, True, True, True],
+            "=IF(Date > DATE(2025, 2, 1), UPPER(\"yes\"), LOWER(\"NO\"))": ["no", "no", "YES", "YES"],
+        }
+        plain = FormulaToPolarsListener(optimize=False)
+        for formula, expected_values in optimizer_cases.items():
+            try:
+                unoptimized_values = df.with_columns(x=plain.convert_to_expr(formula))["x"].to_list()
+            except Exception:
+                unoptimized_values = None  # e.g. date + int does not evaluate unoptimized
+            optimized_values = df.with_columns(x=listener.convert_to_expr(formula))["x"].to_list()
+            assert expected_values is None or optimized_values == expected_values, \
+                f"{formula}: expected {expected_values}, got {optimized_values}"
+            assert unoptimized_values is None or optimized_values == unoptimized_values, \
+                f"{formula}: optimized {optimized_values} differs from unoptimized {unoptimized_values}"
+        # A condition that is not boolean is left to IF, which rejects it as it does unoptimized
+        for formula in ("=IF(Quantity, TRUE, FALSE)", "=IF((Quantity), 1, 0)"):
+            try:
+                values = df.with_columns(x=listener.convert_to_expr(formula))["x"].to_list()
+            except Exception:
+                values = None
+            assert values is None, f"{formula}: rewritten for a non-boolean condition, got {values}"
+        explained = listener.explain("=IF(Price * (1 + 0.2) > 100, TRUE, FALSE)")
+        assert "1+0.2 -> 1.2" in explained and "-> predicate" in explained, explained
+        print("Passed: constant folding and boolean simplification")
+        print(explained)
+    except Exception as e:
+        print(f"Error: constant folding and boolean simplification -> {str(e)}")
+
+    # Compiled-formula cache
+    try:
+        cache_listener = FormulaToPolarsListener(cache_size=2)
+        cache_listener.convert_to_expr("=Price + Tax")
+        cache_listener.convert_to_expr("=Price  +   Tax ")
+        assert cache_listener.cache_info() == CacheInfo(hits=1, misses=1, maxsize=2, currsize=1)
+        cache_listener.convert_to_expr("=CONCAT(Name, \"  \")")
+        cache_listener.convert_to_expr("=CONCAT(Name, \" \")")
+        cache_listener.convert_to_expr("=TODAY()")
+        assert cache_listener.cache_info().currsize == 2, "cache must stay bounded and skip volatile formulas"
+        cache_listener.register_custom_function('DOUBLE', lambda args: f"({args[0]} * 2)")
+        assert cache_listener.cache_info() == CacheInfo(hits=0, misses=0, maxsize=2, currsize=0)
+        # Functions registered on one listener are not visible to another
+        assert 'numpy' in listener.udf_modules and not cache_listener.udf_modules
+        print("Passed: compiled formula cache")
+    except Exception as e:
+        print(f"Error: compiled formula cache -> {str(e)}")
 
 
 if __name__ == "__main__":
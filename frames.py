@@ -0,0 +1,13 @@
+from typing import List, Union
+
+import polars as pl
+
+# Helpers shared by the formula compiler and the data quality engine, which both take eager or lazy
+# frames. Kept apart so the compiler does not import the engine, nor the engine the compiler.
+
+Frame = Union[pl.DataFrame, pl.LazyFrame]
+
+
+def _column_names(df: Frame) -> List[str]:
+    """Column names of an eager or lazy frame (resolving a lazy schema, not the data)."""
+    return df.collect_schema().names() if isinstance(df, pl.LazyFrame) else df.columns